@@ -1,73 +1,180 @@
-from sqlalchemy import select, delete
-from database import AsyncSessionLocal
+from sqlalchemy import select, delete, bindparam
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from database import AsyncSessionLocal, engine, dialect_insert
 from models import Admin
+from admin_settings import get_admin_setting
 from config import config
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger("vpn_bot.admin_mgmt")
 
+# Statements built once and reused so every call hits the compiled cache
+_SEL_ADMIN_IDS = select(Admin.telegram_id)
+_DEL_ADMIN_BY_TID = delete(Admin).where(Admin.telegram_id == bindparam("tid"))
+
+# admin_panel imports this module, so admin_start is resolved once on first use
+_admin_start = None
+
+# Secret keyword cache: (keyword, expires_at)
+SECRET_KEYWORD_TTL = 60
+_secret_keyword_cache: tuple[str, float] | None = None
+
+# Admin rows for the management menu: (admins, expires_at)
+ADMIN_LIST_TTL = 60
+_admin_list_cache: tuple[list, float] | None = None
+
+# DB admin IDs, kept in sync by add_admin/remove_admin and reloaded every ADMIN_IDS_TTL
+# seconds as a safety net for writes made elsewhere (e.g. a restored DB import)
+ADMIN_IDS_TTL = 300
+_db_admin_ids: set[int] = set()
+_db_admin_ids_loaded = asyncio.Event()
+_db_admin_ids_expires = 0.0
+# In-flight load shared by concurrent callers during a cold start
+_load_task: asyncio.Task | None = None
+
+async def _load_admin_ids():
+    global _db_admin_ids_expires
+    ids = await list_admin_ids()
+    _db_admin_ids.clear()
+    _db_admin_ids.update(ids)
+    _db_admin_ids_expires = time.monotonic() + ADMIN_IDS_TTL
+    _db_admin_ids_loaded.set()
+
+def _admin_ids_fresh() -> bool:
+    return _db_admin_ids_loaded.is_set() and _db_admin_ids_expires > time.monotonic()
+
+async def _ensure_loaded():
+    """Loads the DB admin IDs into memory on first use (one query for concurrent callers)."""
+    global _load_task
+    if _admin_ids_fresh():
+        return
+    if _load_task is None or _load_task.done():
+        _load_task = asyncio.create_task(_load_admin_ids())
+    # shield: a cancelled caller must not cancel the load others are waiting on
+    await asyncio.shield(_load_task)
+
+def invalidate():
+    """Forces a reload of DB admin IDs (for changes made outside this module)."""
+    global _admin_list_cache
+    _db_admin_ids_loaded.clear()
+    _admin_list_cache = None
+
 async def is_user_admin(telegram_id: int) -> bool:
     """Checks if a user is an admin (either in .env or in DB)."""
     # 1. Check Super Admins from .env
     if telegram_id in config.ADMIN_IDS:
         return True
     
-    # 2. Check DB Admins
-    async with AsyncSessionLocal() as session:
-        res = await session.execute(select(Admin).where(Admin.telegram_id == telegram_id))
-        return res.scalars().first() is not None
+    # 2. Check DB Admins (hash probe; only await when the set isn't loaded or has expired)
+    if not _admin_ids_fresh():
+        await _ensure_loaded()
+    return telegram_id in _db_admin_ids
 
-async def is_super_admin(telegram_id: int) -> bool:
+def is_super_admin(telegram_id: int) -> bool:
     """Only Super Admins (from .env) can manage other admins."""
     return telegram_id in config.ADMIN_IDS
 
-async def add_admin(telegram_id: int, username: str = None, added_by: int = None) -> bool:
-    """Adds a new admin to the database."""
+async def _rollback(session):
+    """Rolls back a failed write so the connection goes back to the pool idle."""
     try:
-        async with AsyncSessionLocal() as session:
-            # Check if already exists
-            res = await session.execute(select(Admin).where(Admin.telegram_id == telegram_id))
-            if res.scalars().first():
-                return False
-            
-            new_admin = Admin(
+        await session.rollback()
+    except SQLAlchemyError as e:
+        # Connection is likely gone; the session close will discard it
+        logger.warning("Rollback failed: %s", e)
+
+async def add_admin(telegram_id: int, username: str = None, added_by: int = None) -> bool:
+    """Adds a new admin to the database. Returns False if already an admin."""
+    async with AsyncSessionLocal() as session:
+        try:
+            stmt = dialect_insert(Admin).values(
                 telegram_id=telegram_id,
                 username=username,
                 added_by=added_by
-            )
-            session.add(new_admin)
+            ).on_conflict_do_nothing(index_elements=[Admin.telegram_id])
+            res = await session.execute(stmt)
             await session.commit()
-            return True
-    except Exception as e:
-        logger.error(f"Error adding admin: {e}")
+        except IntegrityError:
+            await _rollback(session)
+            return False
+        except SQLAlchemyError as e:
+            logger.exception("Error adding admin: %s", e)
+            await _rollback(session)
+            return False
+    if res.rowcount != 1:
         return False
+    global _admin_list_cache
+    _db_admin_ids.add(telegram_id)
+    _admin_list_cache = None
+    return True
 
 async def remove_admin(telegram_id: int) -> bool:
     """Removes an admin from the database."""
-    try:
-        async with AsyncSessionLocal() as session:
-            await session.execute(delete(Admin).where(Admin.telegram_id == telegram_id))
+    async with AsyncSessionLocal() as session:
+        try:
+            await session.execute(_DEL_ADMIN_BY_TID, {"tid": telegram_id})
             await session.commit()
-            return True
-    except Exception as e:
-        logger.error(f"Error removing admin: {e}")
-        return False
+        except SQLAlchemyError as e:
+            logger.exception("Error removing admin: %s", e)
+            await _rollback(session)
+            return False
+    global _admin_list_cache
+    _db_admin_ids.discard(telegram_id)
+    _admin_list_cache = None
+    return True
 
 async def list_admins():
-    """Returns a list of all DB admins."""
+    """Returns a list of all DB admins, re-read at most once per TTL."""
+    global _admin_list_cache
+    if _admin_list_cache and _admin_list_cache[1] > time.monotonic():
+        return _admin_list_cache[0]
     async with AsyncSessionLocal() as session:
         res = await session.execute(select(Admin))
-        return res.scalars().all()
+        admins = res.scalars().all()
+    _admin_list_cache = (admins, time.monotonic() + ADMIN_LIST_TTL)
+    return admins
+
+async def list_admin_ids() -> set[int]:
+    """Returns the telegram IDs of all DB admins (no ORM objects)."""
+    # Plain Core read: no identity map or unit-of-work needed
+    async with engine.connect() as conn:
+        res = await conn.execute(_SEL_ADMIN_IDS)
+        return set(res.scalars().all())
+
+def invalidate_secret_keyword():
+    """Drops the cached secret keyword so the next message re-reads it."""
+    global _secret_keyword_cache
+    _secret_keyword_cache = None
+
+async def get_secret_keyword() -> str:
+    """Returns the admin secret keyword, re-reading the setting at most once per TTL."""
+    global _secret_keyword_cache
+    if _secret_keyword_cache and _secret_keyword_cache[1] > time.monotonic():
+        return _secret_keyword_cache[0]
+    keyword = str(await get_admin_setting('admin_secret_keyword', 'AdminPanel'))
+    _secret_keyword_cache = (keyword, time.monotonic() + SECRET_KEYWORD_TTL)
+    return keyword
 
 async def secret_keyword_listener(update, context):
     """Listens for a secret keyword to open the admin panel."""
     if not update.message or not update.message.text:
         return
     
-    from admin_settings import get_admin_setting
-    secret_keyword = await get_admin_setting('admin_secret_keyword', 'AdminPanel')
+    global _admin_start
+    text = update.message.text
+    
+    # Fast path: reject non-matching messages against a fresh cache without awaiting.
+    # Anything shorter than the keyword can't match, so skip the strip() copy as well.
+    cached = _secret_keyword_cache
+    if cached and cached[1] > time.monotonic():
+        if len(text) < len(cached[0]) or text.strip() != cached[0]:
+            return
+    
+    if text.strip() != await get_secret_keyword():
+        return
     
-    if update.message.text.strip() == secret_keyword:
-        if await is_user_admin(update.effective_user.id):
-            from admin_panel import admin_start
-            return await admin_start(update, context)
+    if await is_user_admin(update.effective_user.id):
+        if _admin_start is None:
+            from admin_panel import admin_start as _admin_start
+        return await _admin_start(update, context)
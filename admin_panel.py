@@ -1,34 +1,167 @@
+import asyncio
+import html
+import io
 import logging
 import os
+import re
+import tempfile
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from sqlalchemy import select, update
+from sqlalchemy import select, func, bindparam, insert, update as sql_update, delete as sql_delete
+from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime, timedelta
 
 from database import AsyncSessionLocal
-from models import Server, Subscription, Profile, User as DBUser, Transaction, AdminSetting, Admin, PaymentReceipt, OvpnConfig
-from mikrotik_manager import MikroTikManager
+from models import Server, Subscription, Profile, User as DBUser, Transaction, AdminSetting, Admin, PaymentReceipt, OvpnConfig, encrypt_text
+from mikrotik_manager import mikrotik_pool
 from admin_management import is_user_admin, is_super_admin, add_admin, remove_admin, list_admins
+from admin_settings import get_admin_settings_many
 from notification_manager import NotificationManager
+from backup_manager import BackupManager, DB_PATH
 from wallet_manager import WalletManager
 from config import config
-from utils import logger
+from utils import logger, elapsed_ms
 
 # States
 SEARCH_USERNAME, USER_ACTION, RESET_PASS, ADD_DATA, EXTEND_TIME, DELETE_CONFIRM, EDIT_BALANCE = range(7)
 WAIT_OVPN_FILE = 7
+MAX_OVPN_BYTES = 256 * 1024  # inline certs make .ovpn files ~10-100 KB
+RECEIPT_APPROVE_PREFIX = "receipt_approve_"
+RECEIPT_REJECT_PREFIX = "receipt_reject_"
+RECEIPTS_PAGE_SIZE = 20  # 2 buttons per receipt; Telegram caps inline keyboards at 100 buttons
 WAIT_IMPORT_FILE = 8
+MAX_IMPORT_BYTES = 500 * 1024 * 1024
+SQLITE_MAGIC = b"SQLite format 3\x00"
 ADMIN_MGMT_ID = 9
 ADD_ADMIN_USERNAME, REMOVE_ADMIN_USERNAME = range(10, 12)
 BROADCAST_MSG, TARGETED_USER_ID, TARGETED_MSG = range(20, 23)
 
 # --- Helpers ---
-def get_mikrotik_manager(server: Server = None):
-    # For now, using default config or first server. 
-    # In full server management, we'd pick based on subscription.server_id
-    if server:
-        return MikroTikManager(host=server.host, username=server.username, password=server.password, port=server.port)
-    return MikroTikManager() # Use defaults from config
+# Numeric input guards (fullmatch): reject bad input without raising ValueError
+_INT_RE = re.compile(r"\d+")
+_AMOUNT_RE = re.compile(r"\d+(\.\d+)?")
+# Trailing numeric id of callbacks like server_edit_12; handler patterns require it
+_CB_ID_RE = re.compile(r"_(\d+)$")
+
+async def mt_call(fn, *args, **kwargs):
+    """Runs a blocking RouterOS API call in the default executor."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+# Per-router circuit breaker for live lookups: (host, port) -> [consecutive_failures, open_until]
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30  # seconds
+_breaker: dict[tuple, list] = {}
+
+async def safe_get_user_info(server, username: str):
+    """get_user_info() that returns None at once while the router is known to be down."""
+    key = (server.host, server.port) if server else (config.MIKROTIK_HOST, config.MIKROTIK_PORT)
+    state = _breaker.get(key)
+    if state and state[1] > time.monotonic():
+        return None
+    try:
+        async with mikrotik_pool.acquire(server) as mgr:
+            info = await mt_call(mgr.get_user_info, username)
+    except Exception as e:
+        logger.warning(f"MikroTik {key[0]} unreachable: {e}")
+        state = _breaker.setdefault(key, [0, 0.0])
+        state[0] += 1
+        if state[0] >= BREAKER_THRESHOLD:
+            # Open (or re-open after a failed half-open probe)
+            state[1] = time.monotonic() + BREAKER_COOLDOWN
+        return None
+    _breaker.pop(key, None)
+    return info
+
+# (id, name) of every server, reused for SERVER_CACHE_TTL seconds; "ts" 0.0 means empty
+# and "ver" bumps on every server change
+SERVER_CACHE_TTL = 30
+_server_cache = {"ts": 0.0, "rows": [], "ver": 0}
+_SERVER_ROWS = select(Server.id, Server.name).order_by(Server.id)
+
+async def get_servers_cached(ttl: float = SERVER_CACHE_TTL):
+    """Returns [(id, name), ...] for all servers, hitting the DB at most once per ttl."""
+    ts = _server_cache["ts"]
+    if ts and time.monotonic() - ts < ttl:
+        return _server_cache["rows"]
+    ver = _server_cache["ver"]
+    async with AsyncSessionLocal() as session:
+        rows = [tuple(r) for r in (await session.execute(_SERVER_ROWS)).all()]
+    if ver == _server_cache["ver"]:  # don't store a list a concurrent change made stale
+        _server_cache.update(ts=time.monotonic(), rows=rows)
+    return rows
+
+def invalidate_server_cache():
+    """Drops the cached server list after a server is added, edited or deleted."""
+    _server_cache["ts"] = 0.0
+    _server_cache["ver"] += 1
+
+# Statements built once and reused so every call hits the compiled cache
+_SUB_BY_NAME = select(Subscription).where(Subscription.mikrotik_username == bindparam("u"))
+_SUB_WITH_SERVER_BY_NAME = _SUB_BY_NAME.options(joinedload(Subscription.server))
+_USER_BY_SUB_NAME = select(DBUser).join(Subscription).where(Subscription.mikrotik_username == bindparam("u"))
+_SET_SUB_PASSWORD = (
+    sql_update(Subscription)
+    .where(Subscription.mikrotik_username == bindparam("u"))
+    .values(mikrotik_password=bindparam("pw"))
+)
+_ADD_SUB_BYTES = (
+    sql_update(Subscription)
+    .where(Subscription.mikrotik_username == bindparam("u"))
+    .values(total_limit_bytes=Subscription.total_limit_bytes + bindparam("delta"))
+    .returning(Subscription.id)
+)
+_DEL_SUB_BY_NAME = (
+    sql_delete(Subscription)
+    .where(Subscription.mikrotik_username == bindparam("u"))
+    .returning(Subscription.id)
+)
+_PENDING_RECEIPTS_PAGE = (
+    select(PaymentReceipt)
+    .options(joinedload(PaymentReceipt.user))
+    .where(PaymentReceipt.status == 'pending', PaymentReceipt.id > bindparam("after"))
+    .order_by(PaymentReceipt.id)
+    .limit(RECEIPTS_PAGE_SIZE + 1)
+)
+# Plain INSERT ... RETURNING id: no unit-of-work flush for one-row admin inserts
+_INSERT_PROFILE = insert(Profile).returning(Profile.id)
+_INSERT_SERVER = insert(Server).returning(Server.id)
+# Server eager-loaded in one extra IN query; a lazy load per profile can't run under asyncio
+_ACTIVE_PROFILES = (
+    select(Profile)
+    .options(selectinload(Profile.server))
+    .where(Profile.is_active == True)
+)
+_ACTIVE_SUBS_PER_PROFILE = (
+    select(Subscription.profile_id, func.count(Subscription.id))
+    .where(Subscription.status == 'active')
+    .group_by(Subscription.profile_id)
+)
+_RECEIPT_WITH_USER = (
+    select(PaymentReceipt)
+    .options(joinedload(PaymentReceipt.user))
+    .where(PaymentReceipt.id == bindparam("rid"))
+)
+
+# Admin main menu markups are static, so build them once (PTB markups are immutable)
+_ADMIN_MENU_ROWS = [
+    [InlineKeyboardButton("🔍 Search User", callback_data='search_user')],
+    [InlineKeyboardButton("📡 Server List", callback_data='list_servers'),
+     InlineKeyboardButton("📦 Profiles", callback_data='list_profiles')],
+    [InlineKeyboardButton("📋 Pending Receipts", callback_data='pending_receipts')],
+    [InlineKeyboardButton("💬 Support Tickets", callback_data='admin_tickets'),
+     InlineKeyboardButton("📊 Sales Reports", callback_data='admin_reports')],
+    [InlineKeyboardButton("🔐 Connection Status", callback_data='connection_status_menu'),
+     InlineKeyboardButton("📂 Backup & Migration", callback_data='backup_menu')],
+    [InlineKeyboardButton("⚙️ Bot Configs", callback_data='bot_config_menu')],
+    [InlineKeyboardButton("📢 Notifications", callback_data='notification_menu')],
+]
+ADMIN_MENU_TEXT = "👮‍♂️ **Admin Panel**\nSelect an action:"
+ADMIN_MENU_MARKUP = InlineKeyboardMarkup(_ADMIN_MENU_ROWS)
+# Only Super Admins see Admin Management
+SUPER_ADMIN_MENU_MARKUP = InlineKeyboardMarkup(
+    _ADMIN_MENU_ROWS + [[InlineKeyboardButton("👮‍♂️ Admin Management", callback_data='admin_mgmt_menu')]]
+)
 
 async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin main menu."""
@@ -36,35 +169,18 @@ async def admin_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_user_admin(user_id):
         return # Silent fail for security
 
-    keyboard = [
-        [InlineKeyboardButton("🔍 Search User", callback_data='search_user')],
-        [InlineKeyboardButton("📡 Server List", callback_data='list_servers'),
-         InlineKeyboardButton("📦 Profiles", callback_data='list_profiles')],
-        [InlineKeyboardButton("📋 Pending Receipts", callback_data='pending_receipts')],
-        [InlineKeyboardButton("💬 Support Tickets", callback_data='admin_tickets'),
-         InlineKeyboardButton("📊 Sales Reports", callback_data='admin_reports')],
-        [InlineKeyboardButton("🔐 Connection Status", callback_data='connection_status_menu'),
-         InlineKeyboardButton("📂 Backup & Migration", callback_data='backup_menu')],
-        [InlineKeyboardButton("⚙️ Bot Configs", callback_data='bot_config_menu')],
-        [InlineKeyboardButton("📢 Notifications", callback_data='notification_menu')],
-    ]
-    
-    # Only Super Admins see Admin Management
-    if await is_super_admin(user_id):
-        keyboard.append([InlineKeyboardButton("👮‍♂️ Admin Management", callback_data='admin_mgmt_menu')])
-        
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    text = "👮‍♂️ **Admin Panel**\nSelect an action:"
+    reply_markup = SUPER_ADMIN_MENU_MARKUP if is_super_admin(user_id) else ADMIN_MENU_MARKUP
     
     if update.callback_query:
-        await update.callback_query.message.edit_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.callback_query.message.edit_text(ADMIN_MENU_TEXT, reply_markup=reply_markup, parse_mode='Markdown')
     else:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(ADMIN_MENU_TEXT, reply_markup=reply_markup, parse_mode='Markdown')
     return ConversationHandler.END
 
 # --- Server Management ---
 
+SERVER_LIST_HEADER = "📡 **Server List**\n━━━━━━━━━━━━━━━━━━━━\n\n"
+
 async def list_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all servers with status."""
     query = update.callback_query
@@ -74,27 +190,25 @@ async def list_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
         result = await session.execute(select(Server))
         servers = result.scalars().all()
         
-    text = "📡 **Server List**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
+    parts = [SERVER_LIST_HEADER]
     
     if not servers:
-        text += "No servers configured."
+        parts.append("No servers configured.")
     
-    for s in servers:
-        status = "🟢 Active" if s.is_active else "🔴 Disabled"
-        
-        text += (
-            f"**{s.name}** {status}\n"
-            f"Host: `{s.host}:{s.port}`\n"
-            f"-------------------\n"
-        )
-        
-        keyboard.append([
-            InlineKeyboardButton(f"🔄 Test", callback_data=f"server_test_{s.id}"),
-            InlineKeyboardButton(f"✏️ Edit", callback_data=f"server_edit_{s.id}"),
-            InlineKeyboardButton(f"🗑 Delete", callback_data=f"server_delete_{s.id}")
-        ])
-        
+    parts.extend(
+        f"**{s.name}** {'🟢 Active' if s.is_active else '🔴 Disabled'}\n"
+        f"Host: `{s.host}:{s.port}`\n"
+        f"-------------------\n"
+        for s in servers
+    )
+    text = "".join(parts)
+    
+    keyboard = [
+        [InlineKeyboardButton("🔄 Test", callback_data=f"server_test_{s.id}"),
+         InlineKeyboardButton("✏️ Edit", callback_data=f"server_edit_{s.id}"),
+         InlineKeyboardButton("🗑 Delete", callback_data=f"server_delete_{s.id}")]
+        for s in servers
+    ]
     keyboard.append([InlineKeyboardButton("➕ Add Server", callback_data='server_add')])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='admin_start')])
     
@@ -104,7 +218,7 @@ async def list_servers(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def test_server_connection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test connection to specific server."""
     query = update.callback_query
-    server_id = int(query.data.split('_')[2])
+    server_id = int(_CB_ID_RE.search(query.data).group(1))
     
     await query.answer("Testing connection...", cache_time=0)
     
@@ -115,20 +229,17 @@ async def test_server_connection(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("❌ Server not found.")
         return
         
-    start_time = datetime.now()
+    start_ns = time.perf_counter_ns()
     try:
-        mgr = get_mikrotik_manager(server)
-        mgr.connect()
-        
-        # Fetch basic stats
-        resource = mgr._get_resource('/system/resource')
-        res_data = resource.get()[0]
-        
-        active_sessions = len(mgr._get_resource('/user-manager/session').get(active='true'))
+        # One pooled connection, two reads in turn: holding a second slot on the same router
+        # while waiting for it can deadlock against the per-router connection limit
+        async with mikrotik_pool.acquire(server) as mgr:
+            resources = await mt_call(lambda: mgr._get_resource('/system/resource').get())
+            sessions = await mt_call(lambda: mgr._get_resource('/user-manager/session').get(active='true'))
+        res_data = resources[0]
+        active_sessions = len(sessions)
         
-        latency = (datetime.now() - start_time).microseconds / 1000
-        
-        mgr.close()
+        latency = elapsed_ms(start_ns)
         
         info = (
             f"✅ **Connection Successful!**\n"
@@ -165,28 +276,21 @@ async def display_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.text.strip()
     
     async with AsyncSessionLocal() as session:
-        # 1. Get Subscription from DB
-        stmt = select(Subscription).where(Subscription.mikrotik_username == username)
-        result = await session.execute(stmt)
+        # 1. Get Subscription and its Server from DB in one query
+        result = await session.execute(_SUB_WITH_SERVER_BY_NAME, {"u": username})
         sub = result.scalars().first()
         
         if not sub:
             await update.message.reply_text(f"❌ User '{username}' not found in Database.")
             return SEARCH_USERNAME
 
-        # 2. Get Live Info from MikroTik
-        # Need server info to connect
-        # stmt_server = select(Server).where(Server.id == sub.server_id)
-        # server_res = await session.execute(stmt_server)
-        # server = server_res.scalars().first()
-        
-        # For now, assume default server or stub
-        mgr = get_mikrotik_manager() 
-        mt_info = mgr.get_user_info(username)
+        # 2. Get Live Info from the subscription's MikroTik (config default if it has none)
+        mt_info = await safe_get_user_info(sub.server, username)
         
         if not mt_info:
+             host = sub.server.host if sub.server else config.MIKROTIK_HOST
              await update.message.reply_text(
-                 f"⚠️ User found in DB but NOT in MikroTik (Server: {mgr.host}).\n"
+                 f"⚠️ User found in DB but NOT in MikroTik (Server: {host}).\n"
                  "They might have been deleted from the router."
              )
              # Still show DB info?
@@ -237,7 +341,7 @@ async def display_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def reset_password_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('reset_pass_')
     context.user_data['target_user'] = username
     await query.edit_message_text(f"🔑 Enter new password for {username}:")
     return RESET_PASS
@@ -246,14 +350,13 @@ async def process_reset_password(update: Update, context: ContextTypes.DEFAULT_T
     new_pass = update.message.text.strip()
     username = context.user_data.get('target_user')
     
-    mgr = get_mikrotik_manager()
-    success = mgr.reset_password(username, new_pass)
+    async with mikrotik_pool.acquire() as mgr:
+        success = await mt_call(mgr.reset_password, username, new_pass)
     
     if success:
         # Update DB
         async with AsyncSessionLocal() as session:
-            stmt = update(Subscription).where(Subscription.mikrotik_username == username).values(mikrotik_password=new_pass)
-            await session.execute(stmt)
+            await session.execute(_SET_SUB_PASSWORD, {"u": username, "pw": new_pass})
             await session.commit()
             
         await update.message.reply_text(f"✅ Password for `{username}` reset to `{new_pass}`.", parse_mode='Markdown')
@@ -265,86 +368,82 @@ async def process_reset_password(update: Update, context: ContextTypes.DEFAULT_T
 async def add_data_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('add_data_')
     context.user_data['target_user'] = username
     await query.edit_message_text(f"➕ Enter GB to add for {username} (e.g., 5):")
     return ADD_DATA
 
 async def process_add_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        gb = int(update.message.text.strip())
-        username = context.user_data.get('target_user')
-        
-        mgr = get_mikrotik_manager()
-        # Note: add_data_to_user in stub just returns True/log. 
-        # Real impl needs to adjust DB total and MT queue.
-        
-        async with AsyncSessionLocal() as session:
-            stmt = select(Subscription).where(Subscription.mikrotik_username == username)
-            result = await session.execute(stmt)
-            sub = result.scalars().first()
-            if sub:
-                sub.total_limit_bytes += gb * 1024**3
-                await session.commit()
-                
-                # Update MT
-                mgr.add_data_to_user(username, gb) # This needs to set NEW TOTAL in MT usually
-                
-                await update.message.reply_text(f"✅ Added {gb}GB to {username}.")
-            else:
-                await update.message.reply_text("❌ User not found in DB.")
-                
-    except ValueError:
+    text = update.message.text.strip()
+    if not _INT_RE.fullmatch(text):
         await update.message.reply_text("❌ Invalid number.")
+        return USER_ACTION
+    gb = int(text)
+    username = context.user_data.get('target_user')
+    
+    # Note: add_data_to_user in stub just returns True/log. 
+    # Real impl needs to adjust DB total and MT queue.
+    
+    async with AsyncSessionLocal() as session:
+        # Atomic in-place bump: one UPDATE ... RETURNING instead of SELECT + flush
+        result = await session.execute(_ADD_SUB_BYTES, {"u": username, "delta": gb * 1024**3})
+        sub_id = result.scalar()
+        await session.commit()
+        if sub_id is not None:
+            # Update MT
+            async with mikrotik_pool.acquire() as mgr:
+                await mt_call(mgr.add_data_to_user, username, gb) # This needs to set NEW TOTAL in MT usually
+            
+            await update.message.reply_text(f"✅ Added {gb}GB to {username}.")
+        else:
+            await update.message.reply_text("❌ User not found in DB.")
         
     return USER_ACTION
 
 async def extend_time_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('extend_time_')
     context.user_data['target_user'] = username
     await query.edit_message_text(f"⏳ Enter days to extend for {username} (e.g., 30):")
     return EXTEND_TIME
 
 async def process_extend_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        days = int(update.message.text.strip())
-        username = context.user_data.get('target_user')
+    text = update.message.text.strip()
+    if not _INT_RE.fullmatch(text):
+        await update.message.reply_text("❌ Invalid number.")
+        return USER_ACTION
+    days = int(text)
+    username = context.user_data.get('target_user')
+    
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(_SUB_BY_NAME, {"u": username})
+        sub = result.scalars().first()
         
-        async with AsyncSessionLocal() as session:
-            stmt = select(Subscription).where(Subscription.mikrotik_username == username)
-            result = await session.execute(stmt)
-            sub = result.scalars().first()
+        if sub:
+            sub.expiry_date += timedelta(days=days)
+            await session.commit()
             
-            if sub:
-                sub.expiry_date += timedelta(days=days)
-                await session.commit()
-                
-                # Check if we need to re-enable in MT
-                mgr = get_mikrotik_manager()
-                mgr.extend_validity(username, days)
-                
-                new_date = sub.expiry_date.strftime('%Y-%m-%d')
-                await update.message.reply_text(f"✅ Extended {username} by {days} days.\nNew Expiry: {new_date}")
-            else:
-                 await update.message.reply_text("❌ User not found in DB.")
-                 
-    except ValueError:
-        await update.message.reply_text("❌ Invalid number.")
+            # Check if we need to re-enable in MT
+            async with mikrotik_pool.acquire() as mgr:
+                await mt_call(mgr.extend_validity, username, days)
+            
+            new_date = sub.expiry_date.strftime('%Y-%m-%d')
+            await update.message.reply_text(f"✅ Extended {username} by {days} days.\nNew Expiry: {new_date}")
+        else:
+             await update.message.reply_text("❌ User not found in DB.")
         
     return USER_ACTION
 
 async def edit_balance_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('edit_balance_')
     context.user_data['target_user'] = username
     
     async with AsyncSessionLocal() as session:
         # Get current balance
-        stmt = select(User).join(Subscription).where(Subscription.mikrotik_username == username)
-        res = await session.execute(stmt)
+        res = await session.execute(_USER_BY_SUB_NAME, {"u": username})
         user = res.scalars().first()
         current_balance = user.wallet_balance if user else 0.0
     
@@ -356,46 +455,44 @@ async def edit_balance_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return EDIT_BALANCE
 
 async def process_edit_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        new_balance = float(update.message.text.strip())
-        username = context.user_data.get('target_user')
+    text = update.message.text.strip()
+    if not _AMOUNT_RE.fullmatch(text):
+        await update.message.reply_text("❌ Invalid amount.")
+        return USER_ACTION
+    new_balance = float(text)
+    username = context.user_data.get('target_user')
+    
+    async with AsyncSessionLocal() as session:
+        # 1. Get user via subscription
+        res = await session.execute(_USER_BY_SUB_NAME, {"u": username})
+        user = res.scalars().first()
         
-        async with AsyncSessionLocal() as session:
-            # 1. Get user via subscription
-            stmt = select(User).join(Subscription).where(Subscription.mikrotik_username == username)
-            res = await session.execute(stmt)
-            user = res.scalars().first()
+        if user:
+            old_balance = user.wallet_balance
+            user.wallet_balance = new_balance
             
-            if user:
-                old_balance = user.wallet_balance
-                user.wallet_balance = new_balance
-                
-                # 2. Record Transaction
-                from models import Transaction
-                txn = Transaction(
-                    user_id=user.id,
-                    amount=new_balance - old_balance,
-                    type='manual_adjustment',
-                    description=f"Admin manual adjustment from ${old_balance:.2f} to ${new_balance:.2f}"
-                )
-                session.add(txn)
-                await session.commit()
-                
-                await update.message.reply_text(f"✅ Balance for {username} updated to ${new_balance:.2f}.")
-            else:
-                await update.message.reply_text("❌ User not found.")
-                
-    except ValueError:
-        await update.message.reply_text("❌ Invalid amount.")
+            # 2. Record Transaction
+            txn = Transaction(
+                user_id=user.id,
+                amount=new_balance - old_balance,
+                type='manual_adjustment',
+                description=f"Admin manual adjustment from ${old_balance:.2f} to ${new_balance:.2f}"
+            )
+            session.add(txn)
+            await session.commit()
+            
+            await update.message.reply_text(f"✅ Balance for {username} updated to ${new_balance:.2f}.")
+        else:
+            await update.message.reply_text("❌ User not found.")
         
     return USER_ACTION
 
 async def disable_user_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('disable_user_')
     
-    mgr = get_mikrotik_manager()
-    success = mgr.disable_user(username)
+    async with mikrotik_pool.acquire() as mgr:
+        success = await mt_call(mgr.disable_user, username)
     
     if success:
         # Update DB status (optional, if we track 'banned' state)
@@ -419,7 +516,7 @@ async def delete_user_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    username = query.data.split('_')[2]
+    username = query.data.removeprefix('delete_user_')
     context.user_data['target_user'] = username
     
     await query.edit_message_text(
@@ -436,17 +533,14 @@ async def process_delete_confirm(update: Update, context: ContextTypes.DEFAULT_T
     username = context.user_data.get('target_user')
     
     if text == 'DELETE':
-        mgr = get_mikrotik_manager()
-        mt_success = mgr.delete_user(username)
+        async with mikrotik_pool.acquire() as mgr:
+            mt_success = await mt_call(mgr.delete_user, username)
         
         if mt_success:
-            # Delete from DB
+            # Delete from DB (single DELETE, no ORM object loaded just to remove it)
             async with AsyncSessionLocal() as session:
-                stmt = select(Subscription).where(Subscription.mikrotik_username == username)
-                res = await session.execute(stmt)
-                sub = res.scalars().first()
-                if sub:
-                    await session.delete(sub)
+                res = await session.execute(_DEL_SUB_BY_NAME, {"u": username})
+                if res.scalar() is not None:
                     await session.commit()
             
             await update.message.reply_text(f"✅ User `{username}` deleted successfully.", parse_mode='Markdown')
@@ -461,33 +555,45 @@ async def process_delete_confirm(update: Update, context: ContextTypes.DEFAULT_T
 # --- Receipt Approval Workflow ---
 
 async def pending_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List pending receipts."""
+    """List pending receipts, one page at a time (callback data: pending_receipts[_after_<id>])."""
     query = update.callback_query
     await query.answer()
     
+    # Keyset paging: continue after the last receipt ID shown on the previous page
+    m = _CB_ID_RE.search(query.data)
+    after_id = int(m.group(1)) if m else 0
+    
     async with AsyncSessionLocal() as session:
-        # Fetch pending receipts
-        stmt = select(PaymentReceipt, User).join(User, PaymentReceipt.user_id == User.id).where(PaymentReceipt.status == 'pending')
-        result = await session.execute(stmt)
-        receipts = result.all() # list of (PaymentReceipt, User)
+        # Fetch pending receipts with their users in one query (one extra row tells us if there's a next page)
+        result = await session.execute(_PENDING_RECEIPTS_PAGE, {"after": after_id})
+        receipts = result.scalars().all()
         
     if not receipts:
         await query.edit_message_text("✅ No pending receipts.")
         return ConversationHandler.END
+    
+    has_more = len(receipts) > RECEIPTS_PAGE_SIZE
+    receipts = receipts[:RECEIPTS_PAGE_SIZE]
 
-    text = "📋 **Pending Receipts**:\n"
-    keyboard = []
+    parts = ["📋 **Pending Receipts**:\n"]
+    parts.extend(
+        f"ID: `{r.id}` - User: {r.user.full_name} (@{r.user.username}) - ${r.amount}\n"
+        for r in receipts
+    )
+    text = "".join(parts)
     
-    for r, u in receipts:
-        text += f"ID: `{r.id}` - User: {u.full_name} (@{u.username}) - ${r.amount}\n"
-        # Add buttons for each? Or a way to select?
-        # Telegram limits buttons. Let's list basic info and provide buttons below for "Next Pending" or specific IDs.
-        # Simple approach: Buttons for Approve/Reject ID
+    # Telegram limits buttons. Let's list basic info and provide buttons below for "Next Pending" or specific IDs.
+    # Simple approach: Buttons for Approve/Reject ID
+    keyboard = []
+    for r in receipts:
+        rid = str(r.id)
         keyboard.append([
-            InlineKeyboardButton(f"✅ Approve #{r.id}", callback_data=f"receipt_approve_{r.id}"),
-            InlineKeyboardButton(f"❌ Reject #{r.id}", callback_data=f"receipt_reject_{r.id}")
+            InlineKeyboardButton("✅ #" + rid, callback_data=RECEIPT_APPROVE_PREFIX + rid),
+            InlineKeyboardButton("❌ #" + rid, callback_data=RECEIPT_REJECT_PREFIX + rid),
         ])
     
+    if has_more:
+        keyboard.append([InlineKeyboardButton("➡️ Next Page", callback_data=f"pending_receipts_after_{receipts[-1].id}")])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='admin_start')])
     
     # Send photos? That's hard in one update.
@@ -501,24 +607,26 @@ async def handle_receipt_action(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     
-    action, receipt_id = query.data.split('_')[1], int(query.data.split('_')[2])
+    _, action, rid = query.data.split('_', 2)
+    receipt_id = int(rid)
     admin_id = update.effective_user.id
     
-    # Get custom messages from admin settings
-    from admin_settings import get_admin_setting
-    approve_msg = await get_admin_setting('receipt_approve_msg', 
-        "✅ Your receipt has been approved!\n\nYour wallet has been credited. Thank you for your payment.")
-    reject_msg = await get_admin_setting('receipt_deny_msg',
-        "❌ Your receipt was rejected.\n\nPlease contact support if you believe this is an error.")
+    # Get custom messages from admin settings (one query for both)
+    msgs = await get_admin_settings_many(['receipt_approve_msg', 'receipt_deny_msg'], {
+        'receipt_approve_msg': "✅ Your receipt has been approved!\n\nYour wallet has been credited. Thank you for your payment.",
+        'receipt_deny_msg': "❌ Your receipt was rejected.\n\nPlease contact support if you believe this is an error.",
+    })
+    approve_msg = msgs['receipt_approve_msg']
+    reject_msg = msgs['receipt_deny_msg']
     
-    # Get receipt info for notification
+    # Get receipt info for notification (receipt + user in one query)
     async with AsyncSessionLocal() as session:
-        receipt = await session.get(PaymentReceipt, receipt_id)
+        receipt = (await session.execute(_RECEIPT_WITH_USER, {"rid": receipt_id})).scalar_one_or_none()
         if not receipt:
             await query.edit_message_text(f"❌ Receipt #{receipt_id} not found.")
             return
         
-        user = await session.get(DBUser, receipt.user_id)
+        user = receipt.user
         user_telegram_id = user.telegram_id if user else None
         receipt_amount = receipt.amount
         receipt_file_id = receipt.receipt_file_id
@@ -578,22 +686,29 @@ async def handle_receipt_action(update: Update, context: ContextTypes.DEFAULT_TY
 
 # --- Settings & File Management ---
 
+CONNECTION_MENU_TEXT = "🔐 **Connection Status**\nSelect a configuration type:"
+CONNECTION_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📂 OVPN Files", callback_data='manage_ovpn')],
+    [InlineKeyboardButton("🔐 L2TP / SSTP Credentials", callback_data='settings_connection')],
+    [InlineKeyboardButton("🔙 Back", callback_data='admin_start')]
+])
+
 async def connection_status_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    text = "🔐 **Connection Status**\nSelect a configuration type:"
-    
-    keyboard = [
-        [InlineKeyboardButton("📂 OVPN Files", callback_data='manage_ovpn')],
-        [InlineKeyboardButton("🔐 L2TP / SSTP Credentials", callback_data='settings_connection')],
-        [InlineKeyboardButton("🔙 Back", callback_data='admin_start')]
-    ]
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(CONNECTION_MENU_TEXT, reply_markup=CONNECTION_MENU_MARKUP, parse_mode='Markdown')
     # If using ConversationHandler, return appropriate state or END if new convo starter
     return ConversationHandler.END
 
+# HTML rather than Markdown: filenames are user-supplied and may contain ` _ *
+OVPN_LIST_HEADER = "📁 <b>OVPN Configurations</b>\n\n"
+OVPN_LIST_FOOTER = "\n\nClick below to upload a new file."
+OVPN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Upload New File", callback_data='upload_ovpn')],
+    [InlineKeyboardButton("🔙 Back", callback_data='connection_status_menu')]
+])
+
 async def manage_ovpn_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -603,21 +718,16 @@ async def manage_ovpn_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         result = await session.execute(select(OvpnConfig))
         configs = result.scalars().all()
         
-    text = "📁 **OVPN Configurations**\n\n"
+    parts = [OVPN_LIST_HEADER]
     if not configs:
-        text += "No files uploaded."
+        parts.append("No files uploaded.")
     else:
-        for c in configs:
-            text += f"📄 `{c.filename}` (Server: {c.server_id or 'All'})\n"
+        parts.extend(f"📄 <code>{html.escape(c.filename)}</code> (Server: {c.server_id or 'All'})\n" for c in configs)
             
-    text += "\n\nClick below to upload a new file."
+    parts.append(OVPN_LIST_FOOTER)
+    text = "".join(parts)
     
-    keyboard = [
-        [InlineKeyboardButton("📤 Upload New File", callback_data='upload_ovpn')],
-        [InlineKeyboardButton("🔙 Back", callback_data='connection_status_menu')]
-    ]
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=OVPN_MENU_MARKUP, parse_mode='HTML')
     return ConversationHandler.END
 
 async def start_ovpn_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -638,10 +748,23 @@ async def process_ovpn_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not filename.endswith('.ovpn'):
         await update.message.reply_text("⚠️ Warning: File doesn't end with .ovpn. Saving anyway.")
         
-    # Download
+    # Reject oversized files before downloading anything
+    if doc.file_size and doc.file_size > MAX_OVPN_BYTES:
+        await update.message.reply_text(f"❌ File too large (max {MAX_OVPN_BYTES // 1024} KB).")
+        return WAIT_OVPN_FILE
+    
+    # Download straight into a BytesIO (no intermediate bytearray copy)
     f = await doc.get_file()
-    content_byte = await f.download_as_bytearray()
-    content_str = content_byte.decode('utf-8') # Assume utf-8
+    buf = io.BytesIO()
+    await f.download_to_memory(buf)
+    if buf.tell() > MAX_OVPN_BYTES:
+        await update.message.reply_text(f"❌ File too large (max {MAX_OVPN_BYTES // 1024} KB).")
+        return WAIT_OVPN_FILE
+    try:
+        content_str = buf.getvalue().decode('utf-8')
+    except UnicodeDecodeError:
+        await update.message.reply_text("❌ File is not valid UTF-8 text.")
+        return WAIT_OVPN_FILE
     
     # Save to DB
     async with AsyncSessionLocal() as session:
@@ -655,7 +778,7 @@ async def process_ovpn_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
         session.add(new_conf)
         await session.commit()
         
-    await update.message.reply_text(f"✅ Saved `{filename}` successfully!", parse_mode='Markdown')
+    await update.message.reply_text(f"✅ Saved <code>{html.escape(filename)}</code> successfully!", parse_mode='HTML')
     return ConversationHandler.END
 
 async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -685,18 +808,29 @@ admin_ovpn_handler = ConversationHandler(
     per_message=False
 )
 
+# One handler for all user-action buttons: a single regex match, then a dict lookup
+_USER_ACTION_ROUTES = {
+    'reset_pass': reset_password_flow,
+    'add_data': add_data_flow,
+    'extend_time': extend_time_flow,
+    'edit_balance': edit_balance_flow,
+    'disable_user': disable_user_flow,
+    'delete_user': delete_user_flow,
+}
+_USER_ACTION_RE = re.compile(r'^(' + '|'.join(_USER_ACTION_ROUTES) + r')_')
+
+async def user_action_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dispatches a user-action callback (e.g. reset_pass_<username>) to its flow."""
+    action = _USER_ACTION_RE.match(update.callback_query.data).group(1)
+    return await _USER_ACTION_ROUTES[action](update, context)
+
 # Handler Definition
 admin_search_user_handler = ConversationHandler(
     entry_points=[CallbackQueryHandler(search_user_start, pattern='^search_user$')],
     states={
         SEARCH_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, display_user_info)],
         USER_ACTION: [
-            CallbackQueryHandler(reset_password_flow, pattern='^reset_pass_'),
-            CallbackQueryHandler(add_data_flow, pattern='^add_data_'),
-            CallbackQueryHandler(extend_time_flow, pattern='^extend_time_'),
-            CallbackQueryHandler(edit_balance_flow, pattern='^edit_balance_'),
-            CallbackQueryHandler(disable_user_flow, pattern='^disable_user_'),
-            CallbackQueryHandler(delete_user_flow, pattern='^delete_user_'),
+            CallbackQueryHandler(user_action_router, pattern=_USER_ACTION_RE),
             CallbackQueryHandler(admin_start, pattern='^admin_start$'),
         ],
         RESET_PASS: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_reset_password)],
@@ -718,32 +852,30 @@ async def list_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Profile).where(Profile.is_active == True))
+        result = await session.execute(_ACTIVE_PROFILES)
         profiles = result.scalars().all()
         
-        # Count active users per profile
-        # Use simple count query
-        # stmt = select(Subscription.profile_id, func.count(Subscription.id)).group_by(Subscription.profile_id)
-        # This requires more complex query. Simple loop for now or optimized later.
+        # Count active users per profile in one GROUP BY query
+        result = await session.execute(_ACTIVE_SUBS_PER_PROFILE)
+        counts = dict(result.all())
         
-    text = "📦 **Active Profiles**\n━━━━━━━━━━━━━━━━━━━━\n\n"
+    parts = ["📦 **Active Profiles**\n━━━━━━━━━━━━━━━━━━━━\n\n"]
     keyboard = []
     
     if not profiles:
-        text += "No profiles found."
+        parts.append("No profiles found.")
         
     for p in profiles:
-        # Get user count (stubbed or separate query)
-        user_count = "?" 
-        text += (
+        parts.append(
             f"**{p.name}** (v{p.version})\n"
             f"💰 ${p.price:.2f} | 📊 {p.data_limit_gb}GB | ⏳ {p.validity_days}d\n"
-            f"Users: {user_count}\n"
+            f"📡 {p.server.name if p.server else 'No server'} | Users: {counts.get(p.id, 0)}\n"
             f"-------------------\n"
         )
         # Edit/Delete buttons (Delete not implemented yet)
         # keyboard.append([InlineKeyboardButton(f"✏️ Edit {p.name}", callback_data=f"edit_profile_{p.id}")]) 
 
+    text = "".join(parts)
     keyboard.append([InlineKeyboardButton("➕ Add New Profile", callback_data='add_profile')])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='admin_start')])
     
@@ -762,59 +894,53 @@ async def get_profile_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return PROFILE_DATA
 
 async def get_profile_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        gb = int(update.message.text.strip())
-        context.user_data['new_profile_data'] = gb
-        await update.message.reply_text("⏳ Enter Validity in Days (e.g., 30):")
-        return PROFILE_DAYS
-    except ValueError:
+    text = update.message.text.strip()
+    if not _INT_RE.fullmatch(text):
         await update.message.reply_text("❌ Invalid number. Enter GB:")
         return PROFILE_DATA
+    context.user_data['new_profile_data'] = int(text)
+    await update.message.reply_text("⏳ Enter Validity in Days (e.g., 30):")
+    return PROFILE_DAYS
 
 async def get_profile_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        days = int(update.message.text.strip())
-        context.user_data['new_profile_days'] = days
-        await update.message.reply_text("💰 Enter Price in $ (e.g., 9.99):")
-        return PROFILE_PRICE
-    except ValueError:
-         await update.message.reply_text("❌ Invalid number. Enter Days:")
-         return PROFILE_DAYS
+    text = update.message.text.strip()
+    if not _INT_RE.fullmatch(text):
+        await update.message.reply_text("❌ Invalid number. Enter Days:")
+        return PROFILE_DAYS
+    context.user_data['new_profile_days'] = int(text)
+    await update.message.reply_text("💰 Enter Price in $ (e.g., 9.99):")
+    return PROFILE_PRICE
 
 async def get_profile_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        price = float(update.message.text.strip())
-        context.user_data['new_profile_price'] = price
+    text = update.message.text.strip()
+    if not _AMOUNT_RE.fullmatch(text):
+        await update.message.reply_text("❌ Invalid price.")
+        return PROFILE_PRICE
+    context.user_data['new_profile_price'] = float(text)
+    
+    servers = await get_servers_cached()
         
-        async with AsyncSessionLocal() as session:
-            res = await session.execute(select(Server))
-            servers = res.scalars().all()
-            
-        if not servers:
-            await update.message.reply_text("❌ No servers found. Please add a server first.")
-            return ConversationHandler.END
-            
-        if len(servers) == 1:
-            # Skip selection if only one server
-            context.user_data['new_profile_server_id'] = servers[0].id
-            return await save_profile_final(update, context)
-            
-        # Show selection keyboard
-        text = "📡 **Select Server for this Profile:**"
-        keyboard = [[InlineKeyboardButton(s.name, callback_data=f"prof_srv_{s.id}")] for s in servers]
+    if not servers:
+        await update.message.reply_text("❌ No servers found. Please add a server first.")
+        return ConversationHandler.END
         
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        return PROFILE_SERVER
+    if len(servers) == 1:
+        # Skip selection if only one server
+        context.user_data['new_profile_server_id'] = servers[0][0]
+        return await save_profile_final(update, context)
         
-    except ValueError:
-        await update.message.reply_text("❌ Invalid price.")
-        return PROFILE_PRICE
+    # Show selection keyboard
+    text = "📡 **Select Server for this Profile:**"
+    keyboard = [[InlineKeyboardButton(name, callback_data=f"prof_srv_{sid}")] for sid, name in servers]
+    
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    return PROFILE_SERVER
 
 async def select_profile_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    server_id = int(query.data.split('_')[2])
+    server_id = int(_CB_ID_RE.search(query.data).group(1))
     context.user_data['new_profile_server_id'] = server_id
     
     return await save_profile_final(update, context)
@@ -826,38 +952,35 @@ async def save_profile_final(update: Update, context: ContextTypes.DEFAULT_TYPE)
     gb = context.user_data['new_profile_data']
     days = context.user_data['new_profile_days']
     
+    # One session for the server lookup and the profile insert
     async with AsyncSessionLocal() as session:
         server = await session.get(Server, server_id)
-        
-    if not server:
-        msg = "❌ Server not found."
-        if update.callback_query: await update.callback_query.edit_message_text(msg)
-        else: await update.message.reply_text(msg)
-        return ConversationHandler.END
+        if not server:
+            msg = "❌ Server not found."
+            if update.callback_query: await update.callback_query.edit_message_text(msg)
+            else: await update.message.reply_text(msg)
+            return ConversationHandler.END
 
-    # Create in MikroTik
-    mgr = get_mikrotik_manager(server)
-    rate_limit = "10M/10M" 
-    
-    success = mgr.create_profile_with_limits(name, days, gb, rate_limit)
-    
-    if success:
-        # Save to DB
-        async with AsyncSessionLocal() as db:
-            new_p = Profile(
-                name=name,
-                data_limit_gb=gb,
-                validity_days=days,
-                price=price,
-                server_id=server.id,
-                version=1
-            )
-            db.add(new_p)
-            await db.commit()
+        # Create in MikroTik
+        rate_limit = "10M/10M" 
         
-        msg = f"✅ Profile `{name}` created successfully on server `{server.name}`!"
-    else:
-        msg = f"❌ Failed to create profile on server `{server.name}` (MikroTik error)."
+        async with mikrotik_pool.acquire(server) as mgr:
+            success = await mt_call(mgr.create_profile_with_limits, name, days, gb, rate_limit)
+        
+        if success:
+            await session.execute(_INSERT_PROFILE, {
+                "name": name,
+                "data_limit_gb": gb,
+                "validity_days": days,
+                "price": price,
+                "server_id": server.id,
+                "version": 1,
+            })
+            await session.commit()
+            
+            msg = f"✅ Profile `{name}` created successfully on server `{server.name}`!"
+        else:
+            msg = f"❌ Failed to create profile on server `{server.name}` (MikroTik error)."
         
     if update.callback_query:
         await update.callback_query.edit_message_text(msg, parse_mode='Markdown')
@@ -873,7 +996,7 @@ admin_profile_handler = ConversationHandler(
         PROFILE_DATA: [MessageHandler(filters.TEXT, get_profile_data)],
         PROFILE_DAYS: [MessageHandler(filters.TEXT, get_profile_days)],
         PROFILE_PRICE: [MessageHandler(filters.TEXT, get_profile_price)],
-        PROFILE_SERVER: [CallbackQueryHandler(select_profile_server, pattern='^prof_srv_')],
+        PROFILE_SERVER: [CallbackQueryHandler(select_profile_server, pattern=r'^prof_srv_\d+$')],
     },
     fallbacks=[CommandHandler('cancel', admin_start), CallbackQueryHandler(admin_start, pattern='^admin_start$')]
 )
@@ -908,10 +1031,8 @@ async def server_pass_received(update: Update, context: ContextTypes.DEFAULT_TYP
     return SERVER_PORT
 
 async def server_port_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        port = int(update.message.text.strip())
-    except ValueError:
-        port = 8728
+    text = update.message.text.strip()
+    port = int(text) if _INT_RE.fullmatch(text) else 8728
     
     name = context.user_data['new_server_name']
     host = context.user_data['new_server_host']
@@ -919,9 +1040,13 @@ async def server_port_received(update: Update, context: ContextTypes.DEFAULT_TYP
     pw = context.user_data['new_server_pass']
     
     async with AsyncSessionLocal() as session:
-        new_server = Server(name=name, host=host, username=user, password=pw, port=port)
-        session.add(new_server)
+        # Core insert bypasses the Server.password setter, so encrypt here
+        await session.execute(_INSERT_SERVER, {
+            "name": name, "host": host, "username": user,
+            "_password": encrypt_text(pw), "port": port,
+        })
         await session.commit()
+    invalidate_server_cache()
     
     await update.message.reply_text(f"✅ Server `{name}` added successfully!", parse_mode='Markdown')
     return ConversationHandler.END
@@ -935,7 +1060,7 @@ async def server_edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    server_id = int(query.data.split('_')[2])
+    server_id = int(_CB_ID_RE.search(query.data).group(1))
     context.user_data['edit_server_id'] = server_id
     
     async with AsyncSessionLocal() as session:
@@ -1016,13 +1141,13 @@ async def server_edit_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif field == 'pass':
             server.password = value
         elif field == 'port':
-            try:
-                server.port = int(value)
-            except ValueError:
+            if not _INT_RE.fullmatch(value):
                 await update.message.reply_text("❌ Invalid port number.")
                 return SERVER_EDIT_VALUE
+            server.port = int(value)
         
         await session.commit()
+    invalidate_server_cache()
     
     await update.message.reply_text(f"✅ Server updated successfully!")
     return ConversationHandler.END
@@ -1032,7 +1157,7 @@ async def server_delete_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    server_id = int(query.data.split('_')[2])
+    server_id = int(_CB_ID_RE.search(query.data).group(1))
     context.user_data['delete_server_id'] = server_id
     
     async with AsyncSessionLocal() as session:
@@ -1067,6 +1192,7 @@ async def server_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TY
             server_name = server.name
             await session.delete(server)
             await session.commit()
+            invalidate_server_cache()
             await update.message.reply_text(f"✅ Server `{server_name}` deleted.", parse_mode='Markdown')
         else:
             await update.message.reply_text("❌ Server not found.")
@@ -1076,8 +1202,8 @@ async def server_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TY
 admin_server_handler = ConversationHandler(
     entry_points=[
         CallbackQueryHandler(server_add_start, pattern='^server_add$'),
-        CallbackQueryHandler(server_edit_start, pattern='^server_edit_'),
-        CallbackQueryHandler(server_delete_start, pattern='^server_delete_')
+        CallbackQueryHandler(server_edit_start, pattern=r'^server_edit_\d+$'),
+        CallbackQueryHandler(server_delete_start, pattern=r'^server_delete_\d+$')
     ],
     states={
         SERVER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, server_name_received)],
@@ -1097,40 +1223,42 @@ admin_server_handler = ConversationHandler(
 
 # --- Backup & Migration ---
 
+BACKUP_MENU_TEXT_TMPL = (
+    "📂 **Backup & Migration**\n"
+    "━━━━━━━━━━━━━━━━━━━━\n\n"
+    "📍 **Auto-Backup Group:** `{gid}`\n"
+    "✨ *Automated backups run every 6 hours.*\n\n"
+    "Select an action:"
+)
+BACKUP_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Export Manual Backup", callback_data='backup_export')],
+    [InlineKeyboardButton("📥 Import Database (Migrate)", callback_data='backup_import')],
+    [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
+])
+
 async def backup_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    group_id = config.BACKUP_GROUP_ID or "Not Set"
-    
-    text = (
-        "📂 **Backup & Migration**\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"📍 **Auto-Backup Group:** `{group_id}`\n"
-        "✨ *Automated backups run every 6 hours.*\n\n"
-        "Select an action:"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("📤 Export Manual Backup", callback_data='backup_export')],
-        [InlineKeyboardButton("📥 Import Database (Migrate)", callback_data='backup_import')],
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
-    ]
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    text = BACKUP_MENU_TEXT_TMPL.format(gid=config.BACKUP_GROUP_ID or "Not Set")
+    await query.edit_message_text(text, reply_markup=BACKUP_MENU_MARKUP, parse_mode='Markdown')
     return ConversationHandler.END
 
+async def _send_manual_backup(bot, chat_id: int):
+    """Background half of manual_export: upload the backup, report failures to the requester."""
+    if not await BackupManager(bot).send_backup_to_telegram(chat_id, is_auto=False):
+        await bot.send_message(chat_id, "❌ Backup failed. Check the bot log for details.")
+
 async def manual_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Preparing backup...")
     
-    from backup_manager import BackupManager
-    mgr = BackupManager(context.bot)
-    
-    # Send to the admin who requested it
-    await mgr.send_backup_to_telegram(update.effective_chat.id, is_auto=False)
+    # Snapshot + sendDocument can take seconds; don't hold the update while it runs
+    context.application.create_task(
+        _send_manual_backup(context.bot, update.effective_chat.id), update=update
+    )
     
-    await query.message.reply_text("✅ Manual backup file sent to your private chat.")
+    await query.message.reply_text("✅ Backup queued; the file will arrive in your private chat shortly.")
     return ConversationHandler.END
 
 async def start_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1155,21 +1283,34 @@ async def process_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not doc or not doc.file_name.endswith('.db'):
         await update.message.reply_text("❌ Please send a valid `.db` file.")
         return WAIT_IMPORT_FILE
+    # Reject oversized files before downloading anything
+    if doc.file_size and doc.file_size > MAX_IMPORT_BYTES:
+        await update.message.reply_text(f"❌ File too large (max {MAX_IMPORT_BYTES // (1024 * 1024)} MB).")
+        return WAIT_IMPORT_FILE
     
     await update.message.reply_text("⏳ Processing database restoration...")
     
-    # Download
-    f = await doc.get_file()
-    temp_path = f"temp_restore_{datetime.now().timestamp()}.db"
-    await f.download_to_drive(temp_path)
-    
-    # Restore
-    from backup_manager import BackupManager
-    success = await BackupManager.restore_database(temp_path)
-    
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
+    # Download next to the DB so the restore is an atomic rename, not a copy
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".db",
+                                     dir=os.path.dirname(os.path.abspath(DB_PATH))) as tmp:
+        temp_path = tmp.name
+    try:
+        f = await doc.get_file()
+        await f.download_to_drive(temp_path)
+        
+        # Trust the header, not the file name
+        with open(temp_path, "rb") as fh:
+            is_sqlite = fh.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
         
+        # Restore
+        success = is_sqlite and await BackupManager.restore_database(temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        
+    if not is_sqlite:
+        await update.message.reply_text("❌ That file is not a SQLite database. Send a `.db` backup file.")
+        return WAIT_IMPORT_FILE
     if success:
         await update.message.reply_text(
             "✅ **Database Restored Successfully!**\n\n"
@@ -1199,36 +1340,35 @@ admin_backup_handler = ConversationHandler(
 
 # --- Admin Management ---
 
+ADMIN_MGMT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add Admin", callback_data='admin_add_start')],
+    [InlineKeyboardButton("➖ Remove Admin", callback_data='admin_remove_start')],
+    [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
+])
+ADMIN_MGMT_BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Admin Management", callback_data='admin_mgmt_menu')]])
+
 async def admin_mgmt_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     user_id = update.effective_user.id
-    if not await is_super_admin(user_id):
+    if not is_super_admin(user_id):
         await query.edit_message_text("❌ Permission denied. Super Admin only.")
         return ConversationHandler.END
         
     admins = await list_admins()
     
-    text = "👮‍♂️ **Admin Management**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    text += f"🏠 **Super Admins (.env):**\n"
-    for sa in config.ADMIN_IDS:
-        text += f"- `{sa}` (Permanent)\n"
+    parts = ["👮‍♂️ **Admin Management**\n━━━━━━━━━━━━━━━━━━━━\n\n🏠 **Super Admins (.env):**\n"]
+    parts.extend(f"- `{sa}` (Permanent)\n" for sa in sorted(config.ADMIN_IDS))
         
-    text += "\n👥 **Database Admins:**\n"
+    parts.append("\n👥 **Database Admins:**\n")
     if not admins:
-        text += "No additional admins found."
+        parts.append("No additional admins found.")
     else:
-        for a in admins:
-            text += f"- `{a.telegram_id}` (@{a.username or 'N/A'})\n"
-            
-    keyboard = [
-        [InlineKeyboardButton("➕ Add Admin", callback_data='admin_add_start')],
-        [InlineKeyboardButton("➖ Remove Admin", callback_data='admin_remove_start')],
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
-    ]
+        parts.extend(f"- `{a.telegram_id}` (@{a.username or 'N/A'})\n" for a in admins)
+    text = "".join(parts)
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=ADMIN_MGMT_MENU_MARKUP, parse_mode='Markdown')
     return ConversationHandler.END
 
 async def admin_add_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1256,11 +1396,11 @@ async def admin_remove_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def admin_mgmt_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = context.user_data.get('admin_mgmt_action')
-    try:
-        target_id = int(update.message.text.strip())
-    except ValueError:
+    text = update.message.text.strip()
+    if not _INT_RE.fullmatch(text):
         await update.message.reply_text("❌ Invalid ID. Please send a numerical ID.")
         return ADMIN_MGMT_ID
+    target_id = int(text)
         
     if action == 'add':
         success = await add_admin(target_id, added_by=update.effective_user.id)
@@ -1272,8 +1412,7 @@ async def admin_mgmt_received(update: Update, context: ContextTypes.DEFAULT_TYPE
             success = await remove_admin(target_id)
             msg = f"✅ Admin `{target_id}` removed." if success else "❌ Error removing admin."
             
-    keyboard = [[InlineKeyboardButton("🔙 Admin Management", callback_data='admin_mgmt_menu')]]
-    await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await update.message.reply_text(msg, reply_markup=ADMIN_MGMT_BACK_MARKUP, parse_mode='Markdown')
     return ConversationHandler.END
 
 admin_mgmt_handler = ConversationHandler(
@@ -1289,23 +1428,22 @@ admin_mgmt_handler = ConversationHandler(
 
 # --- Notification System ---
 
+NOTIFICATION_MENU_TEXT = (
+    "📢 **Notification Center**\n"
+    "━━━━━━━━━━━━━━━━━━━━\n\n"
+    "Select the type of notification you want to send:"
+)
+NOTIFICATION_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📣 Broadcast to All Users", callback_data='notify_broadcast')],
+    [InlineKeyboardButton("🎯 Send to Specific User ID", callback_data='notify_targeted')],
+    [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
+])
+
 async def notification_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    text = (
-        "📢 **Notification Center**\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
-        "Select the type of notification you want to send:"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("📣 Broadcast to All Users", callback_data='notify_broadcast')],
-        [InlineKeyboardButton("🎯 Send to Specific User ID", callback_data='notify_targeted')],
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data='admin_start')]
-    ]
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(NOTIFICATION_MENU_TEXT, reply_markup=NOTIFICATION_MENU_MARKUP, parse_mode='Markdown')
     return ConversationHandler.END
 
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1346,7 +1484,6 @@ async def process_notification(update: Update, context: ContextTypes.DEFAULT_TYP
     
     status_msg = await update.message.reply_text("⏳ Processing notification...")
     
-    from notification_manager import NotificationManager
     mgr = NotificationManager(context.bot)
     
     if is_broadcast:
@@ -1365,7 +1502,6 @@ async def process_notification(update: Update, context: ContextTypes.DEFAULT_TYP
         result_text = f"✅ Message sent to `{target_id}`." if success else f"❌ Failed to send to `{target_id}`."
         
     await status_msg.edit_text(result_text, parse_mode='Markdown')
-    from admin_panel import admin_start
     await admin_start(update, context)
     return ConversationHandler.END
 
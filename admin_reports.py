@@ -3,69 +3,115 @@ Admin Reports & Analytics Module
 Provides sales summaries, revenue statistics, and CSV exports.
 """
 
+import asyncio
+import codecs
+import gzip
 import io
 import csv
-from datetime import datetime, timedelta
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone, time as dt_time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, case, bindparam, cast, String
 
-from database import AsyncSessionLocal
+from database import AsyncSessionLocal, engine
 from models import User, Subscription, Transaction, Profile
 
-async def sales_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display comprehensive sales dashboard."""
-    query = update.callback_query
-    if query:
-        await query.answer()
-
-    # Time ranges
-    now = datetime.utcnow()
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    week_start = today_start - timedelta(days=7)
-    month_start = today_start - timedelta(days=30)
+# Dashboard metrics: one row per table via conditional aggregates
+_REVENUE_STATS = select(
+    func.coalesce(func.sum(Transaction.amount), 0.0),
+    func.coalesce(func.sum(case((Transaction.created_at >= bindparam("today"), Transaction.amount))), 0.0),
+    func.coalesce(func.sum(case((Transaction.created_at >= bindparam("month"), Transaction.amount))), 0.0),
+).where(Transaction.type == 'purchase')
+# count(*) over select_from: one pass, answerable from the date index alone
+_SUBSCRIPTION_STATS = select(
+    func.count(),
+    func.count().filter(Subscription.expiry_date > bindparam("now")),
+).select_from(Subscription)
+_USER_STATS = select(
+    func.count(),
+    func.count().filter(User.created_at >= bindparam("today")),
+).select_from(User)
+
+def _minute_text(col):
+    """created_at as 'YYYY-MM-DD HH:MM' text, formatted by the database."""
+    if engine.dialect.name == "sqlite":
+        return func.strftime('%Y-%m-%d %H:%M', col)
+    if engine.dialect.name == "postgresql":
+        return func.to_char(col, 'YYYY-MM-DD HH24:MI')
+    return cast(col, String)
+
+# Cheap probe: no users means no subscriptions or transactions either
+_ANY_USER = select(1).select_from(User).limit(1)
+
+# Join Transaction with User for better reporting; plain columns, no ORM objects per row.
+# Date and amount come back as text, so the writer only has to quote
+_SALES_EXPORT = (
+    select(
+        Transaction.id, User.telegram_id, cast(Transaction.amount, String),
+        _minute_text(Transaction.created_at), Transaction.description,
+    )
+    .join(User, Transaction.user_id == User.id)
+    .where(Transaction.type == 'purchase')
+    .order_by(Transaction.created_at.desc())
+    # Server-side cursor fetching 1000 rows at a time (session.stream() sets stream_results)
+    .execution_options(yield_per=1000)
+)
+CSV_SPOOL_BYTES = 2 * 1024 * 1024
+CSV_HEADER = ['ID', 'Telegram ID', 'Amount', 'Date', 'Description']
+
+# PostgreSQL: let the server's COPY encoder produce the whole CSV (header included)
+_PG_SALES_COPY = """
+    SELECT t.id AS "ID", u.telegram_id AS "Telegram ID", t.amount AS "Amount",
+           to_char(t.created_at, 'YYYY-MM-DD HH24:MI') AS "Date", t.description AS "Description"
+    FROM transactions t JOIN users u ON t.user_id = u.id
+    WHERE t.type = 'purchase'
+    ORDER BY t.created_at DESC
+"""
 
+async def _fetch_row(stmt, params: dict):
+    """Runs one aggregate on its own session (own pooled connection) so several can overlap."""
     async with AsyncSessionLocal() as session:
-        # 1. Revenue Stats (from Transactions type='purchase')
-        # Total
-        total_rev = await session.execute(
-            select(func.sum(Transaction.amount)).where(Transaction.type == 'purchase')
-        )
-        total_rev = total_rev.scalar() or 0.0
-
-        # Today
-        today_rev = await session.execute(
-            select(func.sum(Transaction.amount)).where(
-                and_(Transaction.type == 'purchase', Transaction.created_at >= today_start)
-            )
-        )
-        today_rev = today_rev.scalar() or 0.0
+        res = await session.execute(stmt, params)
+        return res.one()
 
-        # Month
-        month_rev = await session.execute(
-            select(func.sum(Transaction.amount)).where(
-                and_(Transaction.type == 'purchase', Transaction.created_at >= month_start)
-            )
-        )
-        month_rev = month_rev.scalar() or 0.0
+DASHBOARD_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Refresh", callback_data='admin_reports')],
+    [InlineKeyboardButton("📝 Export Sales CSV", callback_data='report_export_sales')],
+    [InlineKeyboardButton("🔙 Back to Admin", callback_data='admin_start')],
+])
 
-        # 2. Subscription counts
-        total_subs = await session.execute(select(func.count(Subscription.id)))
-        total_subs = total_subs.scalar() or 0
+# Rendered dashboard, reused for DASHBOARD_TTL seconds (refresh / back button spam)
+DASHBOARD_TTL = 60
+_dash_cache = {"ts": 0.0, "text": None}
 
-        active_subs = await session.execute(
-            select(func.count(Subscription.id)).where(Subscription.expiry_date > now)
-        )
-        active_subs = active_subs.scalar() or 0
+async def _render_dashboard() -> str:
+    """Runs the dashboard aggregates and formats the message."""
+    # Time ranges
+    now = datetime.now(timezone.utc)
+    today_start = datetime.combine(now.date(), dt_time.min, tzinfo=timezone.utc)
+    month_start = today_start - timedelta(days=30)
 
-        # 3. User Growth
-        total_users = await session.execute(select(func.count(User.id)))
-        total_users = total_users.scalar() or 0
+    async with AsyncSessionLocal() as session:
+        has_any = await session.scalar(_ANY_USER)
 
-        new_users_today = await session.execute(
-            select(func.count(User.id)).where(User.created_at >= today_start)
+    if not has_any:
+        # Fresh install: every figure is zero, skip the aggregates
+        revenue, subs, users = (0.0, 0.0, 0.0), (0, 0), (0, 0)
+    else:
+        # Independent aggregates, run concurrently: latency is the slowest one, not the sum
+        revenue, subs, users = await asyncio.gather(
+            # 1. Revenue Stats (from Transactions type='purchase'): total, today, last 30d
+            _fetch_row(_REVENUE_STATS, {"today": today_start, "month": month_start}),
+            # 2. Subscription counts
+            _fetch_row(_SUBSCRIPTION_STATS, {"now": now}),
+            # 3. User Growth
+            _fetch_row(_USER_STATS, {"today": today_start}),
         )
-        new_users_today = new_users_today.scalar() or 0
+    total_rev, today_rev, month_rev = revenue
+    total_subs, active_subs = subs
+    total_users, new_users_today = users
 
     text = (
         "📊 **Sales & Analytics Dashboard**\n"
@@ -84,49 +130,87 @@ async def sales_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "━━━━━━━━━━━━━━━━━━━━\n"
         "Last update: " + now.strftime("%Y-%m-%d %H:%M:%S") + " UTC"
     )
+    return text
+
+async def sales_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Display comprehensive sales dashboard."""
+    query = update.callback_query
 
-    keyboard = [
-        [InlineKeyboardButton("📝 Export Sales CSV", callback_data='report_export_sales')],
-        [InlineKeyboardButton("🔙 Back to Admin", callback_data='admin_start')],
-    ]
+    if _dash_cache["text"] is not None and time.monotonic() - _dash_cache["ts"] < DASHBOARD_TTL:
+        text = _dash_cache["text"]
+    else:
+        text = await _render_dashboard()
+        _dash_cache.update(ts=time.monotonic(), text=text)
 
     if query:
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        # Refresh of an unchanged dashboard: skip the edit Telegram would reject as "not modified"
+        sent = (query.message.message_id, text)
+        if query.message.reply_markup == DASHBOARD_MARKUP and context.chat_data.get("dashboard_sent") == sent:
+            await query.answer("Up to date")
+            return
+        await query.answer()
+        await query.edit_message_text(text, reply_markup=DASHBOARD_MARKUP, parse_mode='Markdown')
+        context.chat_data["dashboard_sent"] = sent
     else:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await update.message.reply_text(text, reply_markup=DASHBOARD_MARKUP, parse_mode='Markdown')
+
+async def _copy_sales_csv(session, out):
+    """COPY ... TO STDOUT straight into `out` (asyncpg only)."""
+    conn = await session.connection()
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_from_query(_PG_SALES_COPY, output=out, format='csv', header=True)
+
+async def _write_sales_csv(session, out):
+    """Portable path: stream rows and encode them with csv.writer."""
+    output = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER)
+    output.flush()  # header is out before the query starts
+
+    result = await session.stream(_SALES_EXPORT)
+    # One writerows() per fetched batch keeps the row loop inside the C csv module
+    async for batch in result.partitions():
+        writer.writerows(batch)
+
+    output.flush()
+    output.detach()  # hand the bytes back without closing `out`
+
+async def _do_export(bot, chat_id: int):
+    """Background half of export_sales_csv: build the report and upload it."""
+    # Rows go straight from the result stream into a spooled file: memory stays at
+    # CSV_SPOOL_BYTES however many purchases there are, spilling to disk beyond that.
+    # gzip on the way in (level 1: CSV still shrinks several-fold for little CPU)
+    spool = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_BYTES)
+    try:
+        with gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=1) as gz:
+            gz.write(codecs.BOM_UTF8)  # so Excel opens non-ASCII descriptions as UTF-8
+            async with AsyncSessionLocal() as session:
+                if engine.dialect.driver == "asyncpg":
+                    await _copy_sales_csv(session, gz)
+                else:
+                    await _write_sales_csv(session, gz)
+        spool.seek(0)
+
+        # Send as document
+        await bot.send_document(
+            chat_id=chat_id,
+            document=spool,
+            filename=f"sales_report_{datetime.now().strftime('%Y%m%d')}.csv.gz",
+            caption="📄 **Full Sales Report (CSV, gzip)**\nContains all purchase transactions.",
+            parse_mode='Markdown'
+        )
+    except Exception:
+        await bot.send_message(chat_id, "❌ Sales export failed. Check the bot log for details.")
+        raise
+    finally:
+        spool.close()
 
 async def export_sales_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generate and send CSV report of all sales."""
     query = update.callback_query
     await query.answer("Generating CSV report...")
 
-    async with AsyncSessionLocal() as session:
-        # Join Transaction with User for better reporting
-        stmt = (
-            select(Transaction, User.telegram_id.label('tg_id'))
-            .join(User, Transaction.user_id == User.id)
-            .where(Transaction.type == 'purchase')
-            .order_by(Transaction.created_at.desc())
-        )
-        results = await session.execute(stmt)
-        rows = results.all()
-
-    # Create CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['ID', 'Telegram ID', 'Amount', 'Date', 'Description'])
-
-    for r in rows:
-        txn = r.Transaction
-        writer.writerow([txn.id, r.tg_id, txn.amount, txn.created_at.strftime("%Y-%m-%d %H:%M"), txn.description])
-
-    output.seek(0)
-    
-    # Send as document
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=io.BytesIO(output.getvalue().encode('utf-8')),
-        filename=f"sales_report_{datetime.now().strftime('%Y%m%d')}.csv",
-        caption="📄 **Full Sales Report (CSV)**\nContains all purchase transactions.",
-        parse_mode='Markdown'
+    # Large exports take a while; run them off the handler so the callback returns at once
+    context.application.create_task(
+        _do_export(context.bot, update.effective_chat.id), update=update
     )
@@ -3,257 +3,239 @@ Admin Settings Management Module
 Handles payment cards, custom messages, wallet presets, and connection info.
 """
 
+import asyncio
+import copy
 import json
+import logging
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from sqlalchemy import select
-from datetime import datetime
+from sqlalchemy import select, bindparam
 
-from database import AsyncSessionLocal
+from database import AsyncSessionLocal, dialect_insert
 from models import AdminSetting, Server
 from config import config
 
+logger = logging.getLogger("vpn_bot.admin_settings")
+
 # States for settings conversations
 (SETTINGS_MENU, CARD_NUMBER, CARD_HOLDER, CARD_BANK,
  MESSAGE_KEY, MESSAGE_VALUE,
  PRESET_AMOUNT,
  CONN_SERVER, CONN_L2TP_IP, CONN_L2TP_SECRET, CONN_SSTP_IP) = range(11)
 
+# Decoded settings, {key: (value, expiry)}; written through by set_admin_setting
+SETTINGS_TTL = 30
+_settings_cache: dict[str, tuple] = {}
+_MISSING = object()  # cached "no row / empty value", so the caller's default applies
+# Loads in progress, shared by concurrent cold readers of the same key
+_inflight: dict[str, asyncio.Task] = {}
+# Bumped per key by writes/invalidations (and _cache_epoch for invalidate-all), so a
+# batch read can tell which of its keys changed while its query was in flight
+_write_gen: dict[str, int] = {}
+_cache_epoch = 0
+
+# Write-behind buffer: {key: stored string}, upserted together FLUSH_INTERVAL after the
+# first write (or at FLUSH_BATCH keys), so a run of edits commits as one transaction
+FLUSH_INTERVAL = 0.1
+FLUSH_BATCH = 200
+FLUSH_RETRY = 5  # seconds between attempts while the DB rejects a flush
+_pending_writes: dict[str, str] = {}
+_flush_lock = asyncio.Lock()
+_flush_task: asyncio.Task | None = None
+
+# Column-only reads: plain strings back, no AdminSetting instances
+_SETTING_VALUE = select(AdminSetting.value).where(AdminSetting.key == bindparam("key"))
+_SETTING_VALUES = select(AdminSetting.key, AdminSetting.value).where(
+    AdminSetting.key.in_(bindparam("keys", expanding=True))
+)
+_UPSERT_SETTING = dialect_insert(AdminSetting)
+_UPSERT_SETTING = _UPSERT_SETTING.on_conflict_do_update(
+    index_elements=[AdminSetting.key], set_={'value': _UPSERT_SETTING.excluded.value}
+)
+
 # --- Helper Functions ---
 
+def _decode_value(raw):
+    """Decodes a stored setting string (JSON if possible, else the raw string)."""
+    if not raw:
+        return _MISSING
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+def _cache_value(key: str, value):
+    _settings_cache[key] = (value, time.monotonic() + SETTINGS_TTL)
+
+def _cached(key: str):
+    """Live (value, expiry) entry for key, or None on a miss."""
+    entry = _settings_cache.get(key)
+    if entry and entry[1] > time.monotonic():
+        return entry
+    return None
+
+def _resolve(value, default):
+    # Callers mutate lists/dicts before saving them back: hand out copies
+    return default if value is _MISSING else copy.deepcopy(value)
+
+def _bump_gen(key: str):
+    _write_gen[key] = _write_gen.get(key, 0) + 1
+
+def invalidate_admin_setting(key: str = None):
+    """Drops one cached setting (or all of them) after an out-of-band write."""
+    global _conn_info_migrated, _cache_epoch
+    if key is None:
+        _settings_cache.clear()
+        _inflight.clear()
+        _cache_epoch += 1
+        _conn_info_migrated = False  # a replaced DB may hold a legacy connection_info blob
+    else:
+        _settings_cache.pop(key, None)
+        _inflight.pop(key, None)
+        _bump_gen(key)
+
+async def _load_setting(key: str):
+    if key in _pending_writes:
+        # Written but not flushed yet: the DB row is older than this
+        return _decode_value(_pending_writes[key])
+    async with AsyncSessionLocal() as session:
+        raw = await session.scalar(_SETTING_VALUE, {"key": key})
+    value = _decode_value(raw)
+    # A write or invalidate during the read unregisters us: don't cache what may be stale
+    if _inflight.get(key) is asyncio.current_task():
+        _cache_value(key, value)
+        del _inflight[key]
+    return value
+
 async def get_admin_setting(key: str, default=None):
     """Get admin setting value."""
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(AdminSetting).where(AdminSetting.key == key)
-        )
-        setting = result.scalars().first()
-        if setting:
-            try:
-                return json.loads(setting.value) if setting.value else default
-            except:
-                return setting.value or default
-        return default
+    entry = _cached(key)
+    if entry is not None:
+        return _resolve(entry[0], default)
+    task = _inflight.get(key)
+    if task is None or task.done():
+        task = _inflight[key] = asyncio.create_task(_load_setting(key))
+    # shield: a cancelled caller must not cancel the load others are waiting on
+    return _resolve(await asyncio.shield(task), default)
+
+async def get_admin_settings_many(keys, defaults: dict = None) -> dict:
+    """Get several admin settings in one query. Missing keys fall back to `defaults`."""
+    defaults = defaults or {}
+    values = {}
+    misses = []
+    for k in keys:
+        entry = _cached(k)
+        if entry is None:
+            misses.append(k)
+        else:
+            values[k] = entry[0]
+    if misses:
+        epoch = _cache_epoch
+        gens = {k: _write_gen.get(k, 0) for k in misses}
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(_SETTING_VALUES, {"keys": misses})
+            rows = dict(result.all())
+        rows.update((k, _pending_writes[k]) for k in misses if k in _pending_writes)
+        for k in misses:
+            if epoch == _cache_epoch and gens[k] == _write_gen.get(k, 0):
+                values[k] = _decode_value(rows.get(k))
+                _cache_value(k, values[k])
+            else:
+                # Written or invalidated mid-read: the row may be stale, so don't cache it
+                # and prefer the value the write put in the cache
+                entry = _cached(k)
+                values[k] = entry[0] if entry else _decode_value(rows.get(k))
+    return {k: _resolve(values[k], defaults.get(k)) for k in keys}
+
+async def flush_admin_settings():
+    """Writes buffered settings to the DB in one transaction."""
+    async with _flush_lock:
+        if not _pending_writes:
+            return
+        rows = [{'key': k, 'value': v} for k, v in _pending_writes.items()]
+        _pending_writes.clear()
+        try:
+            async with AsyncSessionLocal() as session:
+                for i in range(0, len(rows), FLUSH_BATCH):
+                    await session.execute(_UPSERT_SETTING, rows[i:i + FLUSH_BATCH])
+                await session.commit()
+        except Exception:
+            # Keep them for the next flush, unless a newer value was buffered meanwhile
+            for row in rows:
+                _pending_writes.setdefault(row['key'], row['value'])
+            raise
+
+async def discard_pending_writes():
+    """Drops buffered writes, e.g. before a restored DB file replaces the current one."""
+    async with _flush_lock:
+        _pending_writes.clear()
+
+def _schedule_flush(delay: float):
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later(delay))
+
+async def _flush_later(delay: float):
+    global _flush_task
+    await asyncio.sleep(delay)
+    _flush_task = None  # writes from here on schedule the next flush
+    try:
+        await flush_admin_settings()
+    except Exception:
+        # The rows are back in the buffer; keep trying rather than wait for another write
+        logger.exception("Flushing admin settings failed; retrying in %ss", FLUSH_RETRY)
+        _schedule_flush(FLUSH_RETRY)
 
 async def set_admin_setting(key: str, value):
-    """Set admin setting value."""
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(AdminSetting).where(AdminSetting.key == key)
-        )
-        setting = result.scalars().first()
-        
-        value_str = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
-        
-        if setting:
-            setting.value = value_str
-            setting.updated_at = datetime.now()
-        else:
-            setting = AdminSetting(key=key, value=value_str)
-            session.add(setting)
-        
-        await session.commit()
+    """Set admin setting value (visible to readers at once, persisted by the next flush)."""
+    value_str = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+    
+    _inflight.pop(key, None)
+    _bump_gen(key)
+    _cache_value(key, _decode_value(value_str))
+    _pending_writes[key] = value_str
+    if len(_pending_writes) >= FLUSH_BATCH:
+        await flush_admin_settings()
+    else:
+        _schedule_flush(FLUSH_INTERVAL)
+    
+    if key == 'admin_secret_keyword':
+        from admin_management import invalidate_secret_keyword
+        invalidate_secret_keyword()
 
 # --- Settings Main Menu ---
 
 # --- Settings Main Menu -> Bot Configs ---
 
+BOT_CONFIG_TEXT = "⚙️ **Bot Configurations**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect category:"
+BOT_CONFIG_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Payment Cards", callback_data='settings_cards')],
+    [InlineKeyboardButton("📝 Custom Messages", callback_data='settings_messages')],
+    [InlineKeyboardButton("💰 Wallet Presets", callback_data='settings_presets')],
+    [InlineKeyboardButton("🎫 Ticket Subjects", callback_data='settings_subjects')],
+    [InlineKeyboardButton("🔙 Back to Admin", callback_data='admin_start')],
+])
+
 async def bot_config_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin Bot Configurations menu."""
     query = update.callback_query
     await query.answer()
     
-    text = "⚙️ **Bot Configurations**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect category:"
-    
-    keyboard = [
-        [InlineKeyboardButton("💳 Payment Cards", callback_data='settings_cards')],
-        [InlineKeyboardButton("📝 Custom Messages", callback_data='settings_messages')],
-        [InlineKeyboardButton("💰 Wallet Presets", callback_data='settings_presets')],
-        [InlineKeyboardButton("🎫 Ticket Subjects", callback_data='settings_subjects')],
-        [InlineKeyboardButton("🔙 Back to Admin", callback_data='admin_start')],
-    ]
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(BOT_CONFIG_TEXT, reply_markup=BOT_CONFIG_MARKUP, parse_mode='Markdown')
     return SETTINGS_MENU
 
 # --- Payment Cards Management ---
 
-async def manage_payment_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display and manage payment cards."""
-    query = update.callback_query
-    await query.answer()
-    
-    cards = await get_admin_setting('payment_cards', [])
-    
-    text = "💳 **Payment Cards**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
-    if cards:
-        for idx, card in enumerate(cards):
-            masked = card.get('number', '')[:4] + '-****-****-' + card.get('number', '')[-4:]
-            bank = card.get('bank', 'Unknown')
-            text += f"{idx + 1}. `{masked}` ({bank})\n"
-            keyboard.append([
-                InlineKeyboardButton(f"🗑 Delete Card {idx + 1}", callback_data=f'card_delete_{idx}')
-            ])
-        text += "\n"
-    else:
-        text += "No cards configured.\n\n"
-    
-    keyboard.append([InlineKeyboardButton("➕ Add New Card", callback_data='card_add')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    return SETTINGS_MENU
-
-# ... (skip add_card helpers, just need to update their return redirects if they call admin_start they are fine, but prefer bot_config_menu when done? Code used admin_start. I'll leave admin_start as it exits the sub-convo.)
-
-# --- Custom Messages Management ---
-
-# ...
-
-async def manage_custom_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display custom messages menu."""
-    query = update.callback_query
-    await query.answer()
-    
-    text = "📝 **Custom Messages**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect message to edit:"
-    keyboard = []
-    
-    for key, label in MESSAGE_TEMPLATES.items():
-        keyboard.append([InlineKeyboardButton(label, callback_data=f'msg_edit_{key}')])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    return SETTINGS_MENU
-
-# ...
-
-# --- Wallet Presets Management ---
-
-async def manage_wallet_presets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Display and manage wallet presets."""
-    query = update.callback_query
-    await query.answer()
-    
-    presets = await get_admin_setting('wallet_presets', [5, 10, 20])
-    
-    text = "💰 **Wallet Charge Presets**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
-    for idx, amount in enumerate(presets):
-        text += f"{idx + 1}. ${amount:.2f}\n"
-        keyboard.append([InlineKeyboardButton(f"🗑 Delete ${amount}", callback_data=f'preset_delete_{idx}')])
-    
-    text += "\n"
-    keyboard.append([InlineKeyboardButton("➕ Add New Preset", callback_data='preset_add')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    return SETTINGS_MENU
-
-# ...
-
-# --- Connection Info Management (L2TP/SSTP) ---
-
-async def manage_connection_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Manage L2TP/SSTP connection info per server."""
-    query = update.callback_query
-    await query.answer()
-    
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Server))
-        servers = result.scalars().all()
-    
-    text = "🔐 **L2TP/SSTP Credentials**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect server to configure:"
-    keyboard = []
-    
-    for server in servers:
-        keyboard.append([InlineKeyboardButton(f"📡 {server.name}", callback_data=f'conn_server_{server.id}')])
-    
-    # BACK POINT: Goes to connection_status_menu (in admin_panel)
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='connection_status_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    return SETTINGS_MENU # We can reuse the state or make a new one, SETTINGS_MENU works if we include usage there.
-
-# ...
+# Static parts of the list menus; the per-item rows are built per render
+CARDS_MENU_HEADER = "💳 **Payment Cards**\n━━━━━━━━━━━━━━━━━━━━\n\n"
+_CARDS_MENU_TAIL = [
+    [InlineKeyboardButton("➕ Add New Card", callback_data='card_add')],
+    [InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')],
+]
 
-async def receive_sstp_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... existing ...
-    # At end:
-    # return await manage_connection_info(update, context) # Or back to admin start? Original led to admin_start
-    # Let's keep original flow or redirect to menu
-    
-    # ... (impl)
-    if update.message.text != '/skip':
-        context.user_data['sstp_ip'] = update.message.text
-    
-    # Save connection info
-    server_id = context.user_data.get('conn_server_id')
-    conn_info = await get_admin_setting('connection_info', {})
-    
-    if str(server_id) not in conn_info:
-        conn_info[str(server_id)] = {
-            'l2tp': {'ip': '', 'port': 1701, 'secret': '123456'},
-            'sstp': {'ip': '', 'port': 443}
-        }
-    
-    if 'l2tp_ip' in context.user_data:
-        conn_info[str(server_id)]['l2tp']['ip'] = context.user_data['l2tp_ip']
-    if 'l2tp_secret' in context.user_data:
-        conn_info[str(server_id)]['l2tp']['secret'] = context.user_data['l2tp_secret']
-    if 'sstp_ip' in context.user_data:
-        conn_info[str(server_id)]['sstp']['ip'] = context.user_data['sstp_ip']
-    
-    await set_admin_setting('connection_info', conn_info)
-    
-    await update.message.reply_text("✅ Connection info updated successfully!")
-    
-    context.user_data.clear()
-    # Go back to list
-    return await manage_connection_info(update, context)
-
-# --- Ticket Subjects ---
-
-async def manage_ticket_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ...
-    # Back button -> bot_config_menu
-    # ...
-    query = update.callback_query
-    await query.answer()
-    
-    subjects = await get_admin_setting('ticket_subjects', [])
-    # ... (fetching logic)
-    
-    # ... (text building)
-    text = "🎫 **Ticket Subjects**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
-    if subjects:
-         for idx, subj in enumerate(subjects):
-            text += f"{idx + 1}. {subj}\n"
-            keyboard.append([
-                InlineKeyboardButton(f"🗑 Delete: {subj[:20]}...", callback_data=f'subj_delete_{idx}')
-            ])
-    else:
-         text += "No custom subjects.\n"
-         
-    keyboard.append([InlineKeyboardButton("➕ Add Subject", callback_data='subj_add')])
-    keyboard.append([InlineKeyboardButton("🔄 Reset", callback_data='subj_reset')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    return SETTINGS_MENU
-
-# ...
-
-# --- Conversation Handlers ---
-
-
-
-# --- Payment Cards Management ---
+def _mask_card(number: str) -> str:
+    return f"{number[:4]}-****-****-{number[-4:]}"
 
 async def manage_payment_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display and manage payment cards."""
@@ -262,25 +244,20 @@ async def manage_payment_cards(update: Update, context: ContextTypes.DEFAULT_TYP
     
     cards = await get_admin_setting('payment_cards', [])
     
-    text = "💳 **Payment Cards**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
     if cards:
-        for idx, card in enumerate(cards):
-            masked = card.get('number', '')[:4] + '-****-****-' + card.get('number', '')[-4:]
-            bank = card.get('bank', 'Unknown')
-            text += f"{idx + 1}. `{masked}` ({bank})\n"
-            keyboard.append([
-                InlineKeyboardButton(f"🗑 Delete Card {idx + 1}", callback_data=f'card_delete_{idx}')
-            ])
-        text += "\n"
+        lines = [
+            f"{idx + 1}. `{_mask_card(card.get('number', ''))}` ({card.get('bank', 'Unknown')})\n"
+            for idx, card in enumerate(cards)
+        ]
+        text = CARDS_MENU_HEADER + "".join(lines) + "\n"
     else:
-        text += "No cards configured.\n\n"
-    
-    keyboard.append([InlineKeyboardButton("➕ Add New Card", callback_data='card_add')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
+        text = CARDS_MENU_HEADER + "No cards configured.\n\n"
+    keyboard = [
+        [InlineKeyboardButton(f"🗑 Delete Card {idx + 1}", callback_data=f'card_delete_{idx}')]
+        for idx in range(len(cards))
+    ]
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard + _CARDS_MENU_TAIL), parse_mode='Markdown')
     return SETTINGS_MENU
 
 async def add_card_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -341,7 +318,7 @@ async def receive_card_bank(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await set_admin_setting('payment_cards', cards)
     
     # Clear context after using data for message
-    masked = context.user_data.get('card_number', '')[:4] + '-****-****-' + context.user_data.get('card_number', '')[-4:]
+    masked = _mask_card(context.user_data.get('card_number', ''))
     card_holder = context.user_data.get('card_holder', 'N/A')
     card_bank = context.user_data.get('card_bank', 'N/A')
     context.user_data.clear()
@@ -398,26 +375,27 @@ MESSAGE_TEMPLATES = {
     'receipt_deny_msg': '❌ Receipt Rejection Message',
 }
 
+MESSAGES_MENU_TEXT = "📝 **Custom Messages**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect message to edit:"
+MESSAGES_MENU_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(label, callback_data=f'msg_edit_{key}')] for key, label in MESSAGE_TEMPLATES.items()]
+    + [[InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')]]
+)
+
 async def manage_custom_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display custom messages menu."""
     query = update.callback_query
     await query.answer()
     
-    text = "📝 **Custom Messages**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect message to edit:"
-    keyboard = []
-    
-    for key, label in MESSAGE_TEMPLATES.items():
-        keyboard.append([InlineKeyboardButton(label, callback_data=f'msg_edit_{key}')])
+    # One IN (...) query warms the settings cache, so opening any message below is a cache hit
+    await get_admin_settings_many(list(MESSAGE_TEMPLATES))
     
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
-    
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(MESSAGES_MENU_TEXT, reply_markup=MESSAGES_MENU_MARKUP, parse_mode='Markdown')
     return SETTINGS_MENU
 
 async def edit_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start editing a message."""
     query = update.callback_query
-    key = query.data.split('_')[2]
+    key = query.data.removeprefix('msg_edit_')
     
     context.user_data['message_key'] = key
     current = await get_admin_setting(key, "Not set")
@@ -433,8 +411,8 @@ async def edit_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def receive_message_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive new message value."""
-    if update.message.text != '/skip':
-        key = context.user_data.get('message_key')
+    key = context.user_data.get('message_key')
+    if update.message.text != '/skip' and update.message.text != await get_admin_setting(key):
         await set_admin_setting(key, update.message.text)
         await update.message.reply_text(f"✅ {MESSAGE_TEMPLATES.get(key, key)} updated successfully!")
     else:
@@ -447,6 +425,12 @@ async def receive_message_value(update: Update, context: ContextTypes.DEFAULT_TY
 
 # --- Wallet Presets Management ---
 
+PRESETS_MENU_HEADER = "💰 **Wallet Charge Presets**\n━━━━━━━━━━━━━━━━━━━━\n\n"
+_PRESETS_MENU_TAIL = [
+    [InlineKeyboardButton("➕ Add New Preset", callback_data='preset_add')],
+    [InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')],
+]
+
 async def manage_wallet_presets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display and manage wallet presets."""
     query = update.callback_query
@@ -454,18 +438,13 @@ async def manage_wallet_presets(update: Update, context: ContextTypes.DEFAULT_TY
     
     presets = await get_admin_setting('wallet_presets', [5, 10, 20])
     
-    text = "💰 **Wallet Charge Presets**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
-    for idx, amount in enumerate(presets):
-        text += f"{idx + 1}. ${amount:.2f}\n"
-        keyboard.append([InlineKeyboardButton(f"🗑 Delete ${amount}", callback_data=f'preset_delete_{idx}')])
-    
-    text += "\n"
-    keyboard.append([InlineKeyboardButton("➕ Add New Preset", callback_data='preset_add')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
+    text = PRESETS_MENU_HEADER + "".join(f"{idx + 1}. ${amount:.2f}\n" for idx, amount in enumerate(presets)) + "\n"
+    keyboard = [
+        [InlineKeyboardButton(f"🗑 Delete ${amount}", callback_data=f'preset_delete_{idx}')]
+        for idx, amount in enumerate(presets)
+    ]
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard + _PRESETS_MENU_TAIL), parse_mode='Markdown')
     return SETTINGS_MENU
 
 async def add_preset_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -522,24 +501,53 @@ async def delete_preset(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Connection Info Management ---
 
+# One row per server ('connection_info:<id>'); the legacy all-servers 'connection_info'
+# blob is split into those rows the first time connection info is read
+_conn_info_migrated = False
+
+def _default_connection_info() -> dict:
+    return {
+        'l2tp': {'ip': '', 'port': 1701, 'secret': '123456'},
+        'sstp': {'ip': '', 'port': 443}
+    }
+
+async def _migrate_legacy_connection_info():
+    global _conn_info_migrated
+    legacy = await get_admin_setting('connection_info', {})
+    if legacy:
+        current = await get_admin_settings_many([f'connection_info:{sid}' for sid in legacy])
+        for sid, info in legacy.items():
+            if current[f'connection_info:{sid}'] is None:
+                await set_admin_setting(f'connection_info:{sid}', info)
+        await set_admin_setting('connection_info', {})
+    _conn_info_migrated = True
+
+async def get_connection_info(server_id: int, default=None):
+    """L2TP/SSTP connection info for one server, or `default` if none is configured."""
+    if not _conn_info_migrated:
+        await _migrate_legacy_connection_info()
+    return await get_admin_setting(f'connection_info:{server_id}', default)
+
+CONNECTION_INFO_TEXT = "🔐 **Connection Information**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect server to configure:"
+_CONNECTION_INFO_TAIL = [[InlineKeyboardButton("🔙 Back", callback_data='connection_status_menu')]]
+
 async def manage_connection_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manage L2TP/SSTP connection info per server."""
     query = update.callback_query
     await query.answer()
     
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(Server))
-        servers = result.scalars().all()
-    
-    text = "🔐 **Connection Information**\n━━━━━━━━━━━━━━━━━━━━\n\nSelect server to configure:"
-    keyboard = []
-    
-    for server in servers:
-        keyboard.append([InlineKeyboardButton(f"📡 {server.name}", callback_data=f'conn_server_{server.id}')])
+    # Same (id, name) list the server admin screens use, invalidated on every server change
+    from admin_panel import get_servers_cached
+    servers = await get_servers_cached()
     
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='connection_status_menu')])
+    keyboard = [
+        [InlineKeyboardButton(f"📡 {name}", callback_data=f'conn_server_{server_id}')]
+        for server_id, name in servers
+    ]
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(
+        CONNECTION_INFO_TEXT, reply_markup=InlineKeyboardMarkup(keyboard + _CONNECTION_INFO_TAIL), parse_mode='Markdown'
+    )
     return SETTINGS_MENU
 
 async def edit_connection_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -549,17 +557,21 @@ async def edit_connection_info(update: Update, context: ContextTypes.DEFAULT_TYP
     
     context.user_data['conn_server_id'] = server_id
     
-    conn_info = await get_admin_setting('connection_info', {})
-    server_info = conn_info.get(str(server_id), {
-        'l2tp': {'ip': '', 'port': 1701, 'secret': '123456'},
-        'sstp': {'ip': '', 'port': 443}
-    })
+    server_info = await get_connection_info(server_id, _default_connection_info())
     
-    async with AsyncSessionLocal() as session:
-        server = await session.get(Server, server_id)
+    # Name from the server list the previous menu was built from; DB only if it has gone stale
+    from admin_panel import get_servers_cached
+    name = dict(await get_servers_cached()).get(server_id)
+    if name is None:
+        async with AsyncSessionLocal() as session:
+            server = await session.get(Server, server_id)
+        if server is None:
+            await query.answer("Server not found", show_alert=True)
+            return SETTINGS_MENU
+        name = server.name
     
     text = (
-        f"🔐 **Connection Info: {server.name}**\n\n"
+        f"🔐 **Connection Info: {name}**\n\n"
         f"**Current L2TP:**\n"
         f"IP: {server_info['l2tp'].get('ip', 'Not set')}\n"
         f"Port: {server_info['l2tp'].get('port', 1701)}\n"
@@ -597,24 +609,23 @@ async def receive_sstp_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Save connection info
     server_id = context.user_data.get('conn_server_id')
-    conn_info = await get_admin_setting('connection_info', {})
-    
-    if str(server_id) not in conn_info:
-        conn_info[str(server_id)] = {
-            'l2tp': {'ip': '', 'port': 1701, 'secret': '123456'},
-            'sstp': {'ip': '', 'port': 443}
-        }
+    current = await get_connection_info(server_id)
+    server_info = current or _default_connection_info()  # get_connection_info returns a copy
     
     if 'l2tp_ip' in context.user_data:
-        conn_info[str(server_id)]['l2tp']['ip'] = context.user_data['l2tp_ip']
+        server_info['l2tp']['ip'] = context.user_data['l2tp_ip']
     if 'l2tp_secret' in context.user_data:
-        conn_info[str(server_id)]['l2tp']['secret'] = context.user_data['l2tp_secret']
+        server_info['l2tp']['secret'] = context.user_data['l2tp_secret']
     if 'sstp_ip' in context.user_data:
-        conn_info[str(server_id)]['sstp']['ip'] = context.user_data['sstp_ip']
-    
-    await set_admin_setting('connection_info', conn_info)
+        server_info['sstp']['ip'] = context.user_data['sstp_ip']
     
-    await update.message.reply_text("✅ Connection info updated successfully!")
+    if not any(k in context.user_data for k in ('l2tp_ip', 'l2tp_secret', 'sstp_ip')) or server_info == current:
+        # Everything skipped or re-entered as-is: nothing to write
+        await update.message.reply_text("Connection info unchanged.")
+    else:
+        # Only this server's row is rewritten
+        await set_admin_setting(f'connection_info:{server_id}', server_info)
+        await update.message.reply_text("✅ Connection info updated successfully!")
     
     context.user_data.clear()
     from admin_panel import admin_start
@@ -625,6 +636,24 @@ async def receive_sstp_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 SUBJECT_VALUE = 12  # New state for subject input
 
+# Default subjects for reference
+DEFAULT_SUBJECTS_TEXT = (
+    "(Using default subjects)\n\n"
+    "**Default Subjects:**\n"
+    "• 🔌 Connection Issues\n"
+    "• 💰 Payment Problem\n"
+    "• 📱 App Help\n"
+    "• 🔄 Renewal Request\n"
+    "• ❓ General Question\n"
+    "\n"
+)
+SUBJECTS_MENU_HEADER = "🎫 **Ticket Subjects**\n━━━━━━━━━━━━━━━━━━━━\n\n"
+_SUBJECTS_MENU_TAIL = [
+    [InlineKeyboardButton("➕ Add Subject", callback_data='subj_add')],
+    [InlineKeyboardButton("🔄 Reset to Defaults", callback_data='subj_reset')],
+    [InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')],
+]
+
 async def manage_ticket_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display and manage ticket subjects."""
     query = update.callback_query
@@ -632,38 +661,17 @@ async def manage_ticket_subjects(update: Update, context: ContextTypes.DEFAULT_T
     
     subjects = await get_admin_setting('ticket_subjects', [])
     
-    # Default subjects for reference
-    default_subjects = [
-        "🔌 Connection Issues",
-        "💰 Payment Problem",
-        "📱 App Help",
-        "🔄 Renewal Request",
-        "❓ General Question"
-    ]
-    
-    text = "🎫 **Ticket Subjects**\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    keyboard = []
-    
     if subjects:
-        text += "**Custom Subjects:**\n"
-        for idx, subj in enumerate(subjects):
-            text += f"{idx + 1}. {subj}\n"
-            keyboard.append([
-                InlineKeyboardButton(f"🗑 Delete: {subj[:20]}...", callback_data=f'subj_delete_{idx}')
-            ])
-        text += "\n"
+        lines = [f"{idx + 1}. {subj}\n" for idx, subj in enumerate(subjects)]
+        text = SUBJECTS_MENU_HEADER + "**Custom Subjects:**\n" + "".join(lines) + "\n"
     else:
-        text += "(Using default subjects)\n\n"
-        text += "**Default Subjects:**\n"
-        for subj in default_subjects:
-            text += f"• {subj}\n"
-        text += "\n"
-    
-    keyboard.append([InlineKeyboardButton("➕ Add Subject", callback_data='subj_add')])
-    keyboard.append([InlineKeyboardButton("🔄 Reset to Defaults", callback_data='subj_reset')])
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='bot_config_menu')])
+        text = SUBJECTS_MENU_HEADER + DEFAULT_SUBJECTS_TEXT
+    keyboard = [
+        [InlineKeyboardButton(f"🗑 Delete: {subj[:20]}...", callback_data=f'subj_delete_{idx}')]
+        for idx, subj in enumerate(subjects)
+    ]
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard + _SUBJECTS_MENU_TAIL), parse_mode='Markdown')
     return SETTINGS_MENU
 
 async def add_subject_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -726,6 +734,43 @@ async def reset_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Conversation Handlers ---
 
+# SETTINGS_MENU callbacks: one dict lookup instead of a regex per handler
+_EXACT_CALLBACKS = {
+    'settings_cards': manage_payment_cards,
+    'settings_messages': manage_custom_messages,
+    'settings_presets': manage_wallet_presets,
+    'settings_connection': manage_connection_info,
+    'settings_subjects': manage_ticket_subjects,
+    'card_add': add_card_start,
+    'preset_add': add_preset_start,
+    'subj_add': add_subject_start,
+    'subj_reset': reset_subjects,
+    'bot_config_menu': bot_config_menu,
+}
+# Keyed by the first two "_"-separated words, e.g. card_delete_3 -> 'card_delete_'
+_PREFIX_CALLBACKS = {
+    'card_delete_': delete_card,
+    'msg_edit_': edit_message_start,
+    'preset_delete_': delete_preset,
+    'conn_server_': edit_connection_info,
+    'subj_delete_': delete_subject,
+}
+
+def _route_settings_callback(data):
+    """Handler for a SETTINGS_MENU callback, or None if it isn't one of ours."""
+    if not isinstance(data, str):
+        return None
+    handler = _EXACT_CALLBACKS.get(data)
+    if handler is None:
+        parts = data.split('_', 2)
+        if len(parts) == 3:
+            handler = _PREFIX_CALLBACKS.get(f"{parts[0]}_{parts[1]}_")
+    return handler
+
+async def dispatch_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Routes a SETTINGS_MENU callback to its handler."""
+    return await _route_settings_callback(update.callback_query.data)(update, context)
+
 admin_settings_handler = ConversationHandler(
     entry_points=[
         CallbackQueryHandler(bot_config_menu, pattern='^bot_config_menu$'),
@@ -736,23 +781,7 @@ admin_settings_handler = ConversationHandler(
         CallbackQueryHandler(manage_ticket_subjects, pattern='^settings_subjects$'),
     ],
     states={
-        SETTINGS_MENU: [
-            CallbackQueryHandler(manage_payment_cards, pattern='^settings_cards$'),
-            CallbackQueryHandler(manage_custom_messages, pattern='^settings_messages$'),
-            CallbackQueryHandler(manage_wallet_presets, pattern='^settings_presets$'),
-            CallbackQueryHandler(manage_connection_info, pattern='^settings_connection$'),
-            CallbackQueryHandler(manage_ticket_subjects, pattern='^settings_subjects$'),
-            CallbackQueryHandler(add_card_start, pattern='^card_add$'),
-            CallbackQueryHandler(delete_card, pattern='^card_delete_'),
-            CallbackQueryHandler(edit_message_start, pattern='^msg_edit_'),
-            CallbackQueryHandler(add_preset_start, pattern='^preset_add$'),
-            CallbackQueryHandler(delete_preset, pattern='^preset_delete_'),
-            CallbackQueryHandler(edit_connection_info, pattern='^conn_server_'),
-            CallbackQueryHandler(add_subject_start, pattern='^subj_add$'),
-            CallbackQueryHandler(delete_subject, pattern='^subj_delete_'),
-            CallbackQueryHandler(reset_subjects, pattern='^subj_reset$'),
-            CallbackQueryHandler(bot_config_menu, pattern='^bot_config_menu$')
-        ],
+        SETTINGS_MENU: [CallbackQueryHandler(dispatch_settings_menu, pattern=_route_settings_callback)],
         CARD_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_card_number)],
         CARD_HOLDER: [MessageHandler(filters.TEXT, receive_card_holder)],
         CARD_BANK: [MessageHandler(filters.TEXT, receive_card_bank)],
@@ -1,32 +1,49 @@
 import asyncio
 import shutil
+import sqlite3
 import os
 import logging
 from datetime import datetime
 from telegram import Bot
 from config import config
+from database import engine
+import admin_management
+import admin_settings
 
 logger = logging.getLogger("vpn_bot.backup")
 
+DB_PATH = "vpn_bot.db"  # Standard path from database.py
+
 class BackupManager:
     """Handles automated and manual database backups."""
     
     def __init__(self, bot: Bot = None):
         self.bot = bot
-        self.db_path = "vpn_bot.db" # Standard path from database.py
+        self.db_path = DB_PATH
         
     async def create_backup_file(self) -> str:
         """Creates a timestamped copy of the database."""
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         backup_filename = f"backup_{timestamp}.db"
-        shutil.copy2(self.db_path, backup_filename)
+        await asyncio.to_thread(self._snapshot, self.db_path, backup_filename)
         return backup_filename
 
-    async def send_backup_to_telegram(self, chat_id: str, is_auto: bool = False):
-        """Sends the database file to a specified Telegram chat."""
+    @staticmethod
+    def _snapshot(src_path: str, dest_path: str):
+        """Consistent copy via SQLite's backup API (includes WAL contents)."""
+        src = sqlite3.connect(src_path)
+        dest = sqlite3.connect(dest_path)
+        try:
+            src.backup(dest)
+        finally:
+            dest.close()
+            src.close()
+
+    async def send_backup_to_telegram(self, chat_id: str, is_auto: bool = False) -> bool:
+        """Sends the database file to a specified Telegram chat. Returns True on success."""
         if not chat_id:
             logger.warning("No BACKUP_GROUP_ID configured. Skipping backup.")
-            return
+            return False
 
         backup_file = None
         try:
@@ -42,8 +59,10 @@ class BackupManager:
                     parse_mode='Markdown'
                 )
             logger.info(f"Backup sent successfully to {chat_id}")
+            return True
         except Exception as e:
             logger.error(f"Failed to send backup: {e}")
+            return False
         finally:
             if backup_file and os.path.exists(backup_file):
                 os.remove(backup_file)
@@ -62,19 +81,35 @@ class BackupManager:
 
     @staticmethod
     async def restore_database(file_path: str) -> bool:
-        """Replaces the current database with a new file."""
+        """Replaces the current database with a new file.
+
+        `file_path` should live on the same filesystem as DB_PATH so the
+        swap is a single atomic rename; the file is consumed on success.
+        """
+        backup_path = f"{DB_PATH}.bak"
         try:
             # 1. Verification: Could check if it's a valid sqlite file
             # 2. Backup current before overwrite
-            if os.path.exists("vpn_bot.db"):
-                shutil.copy2("vpn_bot.db", "vpn_bot.db.bak")
+            if os.path.exists(DB_PATH):
+                await asyncio.to_thread(BackupManager._snapshot, DB_PATH, backup_path)
                 
-            # 3. Overwrite
-            shutil.copy2(file_path, "vpn_bot.db")
+            # Buffered setting writes belong to the old data; flushed later they
+            # would overwrite the restored rows
+            await admin_settings.discard_pending_writes()
+
+            # 3. Overwrite. Close pooled connections first so SQLite checkpoints
+            # and drops the WAL, which must not be replayed onto the new file
+            await engine.dispose()
+            os.replace(file_path, DB_PATH)
+            # Admin IDs cached from the old file must not outlive it (authorization)
+            admin_management.invalidate()
+            admin_settings.invalidate_admin_setting()
+            from admin_panel import invalidate_server_cache  # admin_panel imports this module
+            invalidate_server_cache()
             logger.info("Database restored from uploaded file.")
             return True
         except Exception as e:
             logger.error(f"Restore failed: {e}")
-            if os.path.exists("vpn_bot.db.bak"):
-                shutil.copy2("vpn_bot.db.bak", "vpn_bot.db")
+            if os.path.exists(backup_path):
+                shutil.copy2(backup_path, DB_PATH)
             return False
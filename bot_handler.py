@@ -44,12 +44,9 @@ async def send_config_files(bot, chat_id, subscription: Subscription, server: Se
         await bot.send_message(chat_id, "⚠️ OVPN file not found for this server.")
 
     # 2. L2TP/SSTP Info
-    from admin_settings import get_admin_setting
-    conn_info_all = await get_admin_setting('connection_info', {})
-    
-    server_id_str = str(server.id) if server else "0"
+    from admin_settings import get_connection_info
     # Default if not set
-    s_info = conn_info_all.get(server_id_str, {
+    s_info = await get_connection_info(server.id if server else 0, {
         'l2tp': {'ip': server.host if server else "Unknown", 'port': 1701, 'secret': '123456'},
         'sstp': {'ip': server.host if server else "Unknown", 'port': 443}
     })
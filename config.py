@@ -7,21 +7,31 @@ load_dotenv()
 class Config:
     # Telegram Bot
     BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-    ADMIN_IDS = [int(id_str) for id_str in os.getenv("ADMIN_IDS", "").split(",") if id_str.strip()]
+    ADMIN_IDS = frozenset(int(id_str) for id_str in os.getenv("ADMIN_IDS", "").split(",") if id_str.strip())
+    # Bot API HTTP client (one pooled keep-alive client shared by all handlers)
+    TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", 256))
+    TG_POOL_TIMEOUT = float(os.getenv("TG_POOL_TIMEOUT", 5.0))
+    TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", 15.0))
+    TG_HTTP_VERSION = os.getenv("TG_HTTP_VERSION", "1.1")  # "2" needs the h2 package (httpx[http2])
     
     # Database
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///vpn_bot.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 40))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
     
     # MikroTik Defaults (Optional, specific servers will be in DB)
     MIKROTIK_HOST = os.getenv("MIKROTIK_HOST", "")
     MIKROTIK_USERNAME = os.getenv("MIKROTIK_USERNAME", "")
     MIKROTIK_PASSWORD = os.getenv("MIKROTIK_PASSWORD", "")
     MIKROTIK_PORT = int(os.getenv("MIKROTIK_PORT", 8728))
+    MIKROTIK_MAX_CONNECTIONS = int(os.getenv("MIKROTIK_MAX_CONNECTIONS", 4))  # per router
     
     # App Settings
     DEBUG = os.getenv("DEBUG", "False").lower() == "true"
     
     # Backup Settings
-    BACKUP_GROUP_ID = os.getenv("BACKUP_GROUP_ID", "")
+    BACKUP_GROUP_ID = os.getenv("BACKUP_GROUP_ID", "").strip()
     
 config = Config()
@@ -1,29 +1,74 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from config import config
+import logging
 
-# Create async engine
+logger = logging.getLogger("vpn_bot.database")
+
+# Pool sizing only applies to server databases (SQLite has no connection limit)
+engine_options = {"pool_pre_ping": True}
+if not config.DATABASE_URL.startswith("sqlite"):
+    engine_options.update(
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+    )
+
+# Create async engine (shared by every session in the process)
 engine = create_async_engine(
     config.DATABASE_URL,
     echo=config.DEBUG,
-    future=True
+    future=True,
+    **engine_options
 )
 
-# Async session factory
-AsyncSessionLocal = sessionmaker(
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL lets readers run during a write and, with synchronous=NORMAL,
+        # fsyncs only at checkpoints instead of on every commit
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+# Async session factory (no expire pass after commit; handlers return right away)
+AsyncSessionLocal = async_sessionmaker(
     engine,
-    class_=AsyncSession,
     expire_on_commit=False
 )
 
 Base = declarative_base()
 
+def dialect_insert(model):
+    """INSERT construct with ON CONFLICT support for the configured backend."""
+    if engine.dialect.name == "postgresql":
+        return pg_insert(model)
+    return sqlite_insert(model)
+
 async def get_db():
     """Dependency for getting async database sessions."""
     async with AsyncSessionLocal() as session:
         yield session
 
+def _create_missing_indexes(sync_conn):
+    """create_all() skips indexes on tables that already exist; add any missing ones."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with sync_conn.begin_nested():
+                    index.create(sync_conn, checkfirst=True)
+            except Exception as e:
+                # e.g. duplicate rows in a legacy DB blocking a unique index
+                logger.warning(f"Could not create index {index.name}: {e}")
+
 async def init_db():
     """Initialize database tables."""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
@@ -1,5 +1,6 @@
 import logging
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from config import config
@@ -26,7 +27,7 @@ from admin_panel import (
     admin_mgmt_handler,
     admin_notification_handler
 )
-from admin_settings import admin_settings_handler as admin_settings_conv_handler
+from admin_settings import admin_settings_handler as admin_settings_conv_handler, flush_admin_settings
 from support_tickets import support_ticket_handler
 from admin_tickets import admin_ticket_handler
 from bot_handler import start, wallet_handler, buy_handler, main_menu_callback, wallet_menu, my_subscriptions, buy_service
@@ -34,9 +35,19 @@ from backup_manager import BackupManager
 
 async def post_init(application):
     """Start background tasks."""
+    # Blocking RouterOS calls run via asyncio.to_thread; size the pool for them
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=16))
+    
     mgr = BackupManager(application.bot)
     asyncio.create_task(mgr.run_periodic_backup())
     logger.info("Backup background task started.")
+    
+    from mikrotik_manager import mikrotik_pool
+    asyncio.create_task(mikrotik_pool.run_janitor())
+
+async def post_shutdown(application):
+    """Persist admin setting writes still in the write-behind buffer."""
+    await flush_admin_settings()
 
 def main():
     if not config.BOT_TOKEN:
@@ -50,7 +61,20 @@ def main():
     asyncio.set_event_loop(loop)
     loop.run_until_complete(init_db())
     
-    app = ApplicationBuilder().token(config.BOT_TOKEN).post_init(post_init).build()
+    app = (
+        ApplicationBuilder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(True)
+        # Size the shared Bot API client for concurrent handlers so sends don't queue on the pool
+        .connection_pool_size(config.TG_POOL_SIZE)
+        .pool_timeout(config.TG_POOL_TIMEOUT)
+        .connect_timeout(5.0)
+        .read_timeout(config.TG_READ_TIMEOUT)
+        .http_version(config.TG_HTTP_VERSION)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # User Handlers
     app.add_handler(CommandHandler("start", start))
@@ -71,9 +95,9 @@ def main():
     
     # Admin Callback Handlers (for non-conversation actions)
     app.add_handler(CallbackQueryHandler(list_servers, pattern='^list_servers$'))
-    app.add_handler(CallbackQueryHandler(test_server_connection, pattern='^server_test_'))
+    app.add_handler(CallbackQueryHandler(test_server_connection, pattern=r'^server_test_\d+$'))
     app.add_handler(CallbackQueryHandler(list_profiles, pattern='^list_profiles$'))
-    app.add_handler(CallbackQueryHandler(pending_receipts, pattern='^pending_receipts$'))
+    app.add_handler(CallbackQueryHandler(pending_receipts, pattern=r'^pending_receipts(_after_\d+)?$'))
     app.add_handler(CallbackQueryHandler(handle_receipt_action, pattern='^receipt_(approve|reject)_'))
     
     # Toolbar text button handler (for Reply Keyboard)
@@ -107,9 +131,9 @@ def main():
 
     app.add_handler(MessageHandler(filters.Regex('^⚙️ Settings$'), settings_handler_proxy))
     
-    # Secret Keyword Listener
+    # Secret Keyword Listener (private chats only; group traffic never reaches the callback)
     from admin_management import secret_keyword_listener
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), secret_keyword_listener), group=1)
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & (~filters.COMMAND), secret_keyword_listener), group=1)
     
     # Generic callback handler for main menu actions (must be last)
     app.add_handler(CallbackQueryHandler(main_menu_callback))
@@ -1,9 +1,21 @@
+import asyncio
+import time
 import routeros_api
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
 from typing import Optional, Dict, Any, List, Union
 from datetime import datetime, timedelta
 from config import config
 from utils import logger
 
+# Failures that mean the API session itself is gone (as opposed to a !trap for one command)
+CONNECTION_ERRORS = (
+    routeros_api.exceptions.RouterOsApiConnectionError,
+    routeros_api.exceptions.FatalRouterOsApiError,
+    routeros_api.exceptions.RouterOsApiFatalCommunicationError,
+    OSError,
+)
+
 class MikroTikManager:
     """
     Manager for MikroTik RouterOS interactions.
@@ -17,6 +29,8 @@ class MikroTikManager:
         self.port = port
         self.connection = None
         self.api = None
+        # Set when a call failed at the socket/API-session level; the pool drops it
+        self.broken = False
 
     def connect(self):
         """Establish connection to MikroTik router."""
@@ -40,6 +54,15 @@ class MikroTikManager:
             self.connection.disconnect()
             logger.info("Disconnected from MikroTik")
 
+    def _check_error(self, e: Exception):
+        """Flags the connection as unusable if `e` came from the transport, not the command."""
+        if isinstance(e, CONNECTION_ERRORS):
+            self.broken = True
+
+    def ping(self):
+        """Cheap round trip to check the API session is still alive."""
+        self.api.get_resource('/system/identity').get()
+
     def _get_resource(self, path: str):
         """Helper to get a resource API object."""
         if not self.api:
@@ -68,6 +91,7 @@ class MikroTikManager:
             logger.info(f"Created User Manager user {username} with profile {profile_name}")
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"create_user error: {e}")
             return False
 
@@ -109,6 +133,7 @@ class MikroTikManager:
                 'current_ip': sessions[0].get('address') if is_connected else None
             }
         except Exception as e:
+            self._check_error(e)
             logger.error(f"get_user_info error: {e}")
             return None
 
@@ -129,6 +154,7 @@ class MikroTikManager:
                 return True
             return False
         except Exception as e:
+            self._check_error(e)
             logger.error(f"add_data_to_user error: {e}")
             return False
 
@@ -141,6 +167,7 @@ class MikroTikManager:
                 self.disconnect_user_session(username)
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"disable_user error: {e}")
             return False
 
@@ -152,6 +179,7 @@ class MikroTikManager:
                 user_api.set(id=users[0]['id'], disabled='false')
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"enable_user error: {e}")
             return False
 
@@ -164,6 +192,7 @@ class MikroTikManager:
                 return True
             return False
         except Exception as e:
+            self._check_error(e)
             logger.error(f"reset_password error: {e}")
             return False
 
@@ -181,6 +210,7 @@ class MikroTikManager:
                  return True
             return False
         except Exception as e:
+            self._check_error(e)
             logger.error(f"extend_validity error: {e}")
             return False
 
@@ -199,6 +229,7 @@ class MikroTikManager:
             
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"delete_user error: {e}")
             return False
 
@@ -210,6 +241,7 @@ class MikroTikManager:
                 session_api.remove(id=s['id'])
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"disconnect_user_session error: {e}")
             return False
 
@@ -245,6 +277,141 @@ class MikroTikManager:
             )
             return True
         except Exception as e:
+            self._check_error(e)
             logger.error(f"create_profile_with_limits error: {e}")
             return False
 
+
+
+class MikroTikPool:
+    """
+    Keeps logged-in MikroTikManager connections per router so admin actions
+    don't pay a TCP connect + API login every time.
+    """
+
+    IDLE_TIMEOUT = 300   # seconds a free connection may sit unused
+    MAX_AGE = 3600       # seconds before a connection is recycled regardless
+    PROBE_AFTER = 30     # idle seconds after which a reused connection is pinged first
+
+    def __init__(self, idle_timeout: int = IDLE_TIMEOUT, max_age: int = MAX_AGE,
+                 max_per_router: Optional[int] = None):
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_per_router = max_per_router or config.MIKROTIK_MAX_CONNECTIONS
+        # (host, port, username) -> deque of [manager, created_at, last_used]
+        self._free: Dict[tuple, deque] = defaultdict(deque)
+        # (host, port, username) -> semaphore bounding checked-out connections
+        self._limits: Dict[tuple, asyncio.Semaphore] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(server) -> tuple:
+        if server is None:
+            return (config.MIKROTIK_HOST, config.MIKROTIK_PORT, config.MIKROTIK_USERNAME)
+        return (server.host, server.port, server.username)
+
+    def _expired(self, entry: list, now: float) -> bool:
+        _, created_at, last_used = entry
+        return now - last_used > self.idle_timeout or now - created_at > self.max_age
+
+    @staticmethod
+    def _discard(mgr: MikroTikManager):
+        try:
+            mgr.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled MikroTik connection to {mgr.host}: {e}")
+
+    @classmethod
+    def _alive(cls, mgr: MikroTikManager) -> bool:
+        try:
+            mgr.ping()
+            return True
+        except Exception as e:
+            logger.info(f"Dropping dead pooled MikroTik connection to {mgr.host}: {e}")
+            cls._discard(mgr)
+            return False
+
+    @asynccontextmanager
+    async def acquire(self, server=None):
+        """Yields a connected manager for `server` (config defaults if None)."""
+        key = self._key(server)
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self.max_per_router)
+        # Callers beyond max_per_router wait here instead of opening more sessions
+        async with limit:
+            entry = None
+            stale = []
+            async with self._lock:
+                free = self._free[key]
+                now = time.monotonic()
+                while free:
+                    candidate = free.pop()  # most recently used first
+                    if self._expired(candidate, now):
+                        stale.append(candidate[0])
+                        continue
+                    entry = candidate
+                    break
+            for mgr in stale:
+                await asyncio.to_thread(self._discard, mgr)
+
+            # The router or a NAT in between may have dropped a socket that sat idle
+            if (entry is not None and time.monotonic() - entry[2] > self.PROBE_AFTER
+                    and not await asyncio.to_thread(self._alive, entry[0])):
+                entry = None
+
+            if entry is None:
+                if server is None:
+                    mgr = MikroTikManager(port=config.MIKROTIK_PORT)
+                else:
+                    mgr = MikroTikManager(host=server.host, username=server.username,
+                                          password=server.password, port=server.port)
+                # RouterOS API is blocking; keep the handshake off the event loop
+                await asyncio.to_thread(mgr.connect)
+                now = time.monotonic()
+                entry = [mgr, now, now]
+
+            try:
+                yield entry[0]
+            except BaseException:
+                # Connection state is unknown after a failure; don't hand it out again
+                await asyncio.to_thread(self._discard, entry[0])
+                raise
+            if entry[0].broken:
+                # The wrappers swallow errors, so a dead socket only shows up as this flag
+                await asyncio.to_thread(self._discard, entry[0])
+                return
+            entry[2] = time.monotonic()
+            async with self._lock:
+                self._free[key].append(entry)
+
+    async def evict_expired(self):
+        """Closes free connections that are idle or too old."""
+        now = time.monotonic()
+        stale = []
+        async with self._lock:
+            for key in list(self._free):
+                kept = deque()
+                for e in self._free[key]:
+                    if self._expired(e, now):
+                        stale.append(e[0])
+                    else:
+                        kept.append(e)
+                if kept:
+                    self._free[key] = kept
+                else:
+                    del self._free[key]
+        for mgr in stale:
+            await asyncio.to_thread(self._discard, mgr)
+
+    async def run_janitor(self, interval: int = 60):
+        """Background task: periodically drop expired connections."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_expired()
+            except Exception as e:
+                logger.error(f"MikroTik pool janitor error: {e}")
+
+
+mikrotik_pool = MikroTikPool()
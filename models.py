@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, BigInteger, Text, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, BigInteger, Text, JSON, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -38,6 +38,13 @@ class User(Base):
     subscriptions = relationship("Subscription", back_populates="user")
     transactions = relationship("Transaction", back_populates="user")
     receipts = relationship("PaymentReceipt", back_populates="user")
+    
+    __table_args__ = (
+        # Dashboard "new users today"
+        Index("ix_users_created_at", "created_at"),
+        # Sales export joins transactions -> users only for telegram_id: index-only lookup
+        Index("ix_users_id_telegram_id", "id", "telegram_id"),
+    )
 
 class Server(Base):
     __tablename__ = "servers"
@@ -99,6 +106,13 @@ class Subscription(Base):
     user = relationship("User", back_populates="subscriptions")
     server = relationship("Server", back_populates="subscriptions")
     profile = relationship("Profile", back_populates="subscriptions")
+    
+    __table_args__ = (
+        # Covers the per-profile active user count (GROUP BY profile_id) and profile_id lookups
+        Index("ix_subscriptions_profile_status", "profile_id", "status"),
+        # Dashboard active count (expiry_date > now)
+        Index("ix_subscriptions_expiry_date", "expiry_date"),
+    )
 
 class Transaction(Base):
     __tablename__ = "transactions"
@@ -111,6 +125,15 @@ class Transaction(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     user = relationship("User", back_populates="transactions")
+    
+    __table_args__ = (
+        # Revenue aggregates: only purchase rows, ordered by date, amount alongside
+        Index(
+            "ix_transactions_purchase_created", "created_at", "amount",
+            postgresql_where=text("type = 'purchase'"),
+            sqlite_where=text("type = 'purchase'"),
+        ),
+    )
 
 class PaymentReceipt(Base):
     __tablename__ = "payment_receipts"
@@ -123,7 +146,17 @@ class PaymentReceipt(Base):
     submitted_at = Column(DateTime(timezone=True), server_default=func.now())
     admin_note = Column(String, nullable=True)
     
-    user = relationship("User", back_populates="receipts")
+    # Load explicitly (joinedload) - an implicit lazy load can't run under asyncio anyway
+    user = relationship("User", back_populates="receipts", lazy="raise")
+    
+    __table_args__ = (
+        # Partial index: only pending rows, in the order the admin queue pages through them
+        Index(
+            "ix_payment_receipts_pending", "status", "id",
+            postgresql_where=text("status = 'pending'"),
+            sqlite_where=text("status = 'pending'"),
+        ),
+    )
 
 class AdminSetting(Base):
     __tablename__ = "admin_settings"
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 from typing import List
 from telegram import Bot
 from telegram.error import TelegramError, Forbidden, RetryAfter
@@ -9,6 +10,30 @@ from models import User
 
 logger = logging.getLogger("vpn_bot.notifications")
 
+# Telegram allows ~30 messages/s per bot; stay a little under it
+BROADCAST_RATE = 25      # messages per second
+BROADCAST_WORKERS = 25   # sends in flight at once
+
+
+class RateLimiter:
+    """Spaces callers `1/rate` seconds apart; pause() holds everyone back after a 429."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
 class NotificationManager:
     """Handles mass and targeted notifications."""
     
@@ -34,46 +59,40 @@ class NotificationManager:
     async def broadcast_to_all(self, message: str, parse_mode: str = 'Markdown') -> dict:
         """Sends a message to all active users in the database."""
         async with AsyncSessionLocal() as session:
-            result = await session.execute(select(User).where(User.is_active == True))
-            users = result.scalars().all()
+            result = await session.execute(select(User.telegram_id).where(User.is_active == True))
+            user_ids = result.scalars().all()
             
-        total = len(users)
-        success_count = 0
-        blocked_count = 0
-        failed_count = 0
+        stats = {'total': len(user_ids), 'success': 0, 'blocked': 0, 'failed': 0}
+        limiter = RateLimiter(BROADCAST_RATE)
+        sem = asyncio.Semaphore(BROADCAST_WORKERS)
+        
+        async def send_one(telegram_id: int):
+            async with sem:
+                for attempt in range(2):
+                    await limiter.wait()
+                    try:
+                        await self.bot.send_message(chat_id=telegram_id, text=message, parse_mode=parse_mode)
+                        stats['success'] += 1
+                        return
+                    except Forbidden:
+                        stats['blocked'] += 1
+                        logger.warning(f"User {telegram_id} has blocked the bot.")
+                        return
+                    except RetryAfter as e:
+                        if attempt:
+                            break
+                        # Flood limit is per bot, so every worker backs off
+                        logger.warning(f"Flood limit reached. Waiting {e.retry_after} seconds...")
+                        limiter.pause(e.retry_after)
+                    except TelegramError as e:
+                        logger.error(f"Error broadcasting to {telegram_id}: {e}")
+                        break
+                stats['failed'] += 1
         
-        logger.info(f"Starting broadcast to {total} users...")
+        logger.info(f"Starting broadcast to {stats['total']} users...")
         
-        for user in users:
-            try:
-                await self.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=message,
-                    parse_mode=parse_mode
-                )
-                success_count += 1
-                # Small delay to respect rate limits (approx 30 msgs per second)
-                await asyncio.sleep(0.05) 
-            except Forbidden:
-                blocked_count += 1
-                logger.warning(f"User {user.telegram_id} has blocked the bot.")
-            except RetryAfter as e:
-                logger.warning(f"Flood limit reached. Waiting {e.retry_after} seconds...")
-                await asyncio.sleep(e.retry_after)
-                # Retry once
-                try:
-                    await self.bot.send_message(chat_id=user.telegram_id, text=message, parse_mode=parse_mode)
-                    success_count += 1
-                except: failed_count += 1
-            except TelegramError as e:
-                failed_count += 1
-                logger.error(f"Error broadcasting to {user.telegram_id}: {e}")
+        await asyncio.gather(*(send_one(uid) for uid in user_ids))
                 
-        logger.info(f"Broadcast complete: {success_count} success, {blocked_count} blocked, {failed_count} failed.")
+        logger.info(f"Broadcast complete: {stats['success']} success, {stats['blocked']} blocked, {stats['failed']} failed.")
         
-        return {
-            'total': total,
-            'success': success_count,
-            'blocked': blocked_count,
-            'failed': failed_count
-        }
+        return stats
@@ -5,7 +5,7 @@ from telegram import Update, User as TagUser, Message, CallbackQuery, Chat, Inli
 from telegram.ext import ContextTypes, ConversationHandler
 
 # Modules to test
-from admin_panel import admin_start, connection_status_menu
+from admin_panel import admin_start, connection_status_menu, invalidate_server_cache
 from admin_settings import bot_config_menu, manage_connection_info, manage_payment_cards
 
 @pytest.fixture
@@ -114,6 +114,7 @@ async def test_manage_connection_info_back_link(update_callback_admin, context,
         session.add(mock_server)
         await session.commit()
         await session.refresh(mock_server)
+    invalidate_server_cache()  # seeded behind the admin screens' back
 
     await manage_connection_info(update_callback_admin, context)
     
@@ -138,3 +139,217 @@ async def test_manage_payment_cards_back_link(update_callback_admin, context, ad
     
     assert 'bot_config_menu' in keys
 
+
+@pytest.mark.asyncio
+async def test_user_action_keeps_underscored_username(update_callback_admin, context, admin_patch):
+    # Usernames may contain '_'; the callback prefix must be stripped, not split on
+    from admin_panel import user_action_router, RESET_PASS
+    update_callback_admin.callback_query.data = "reset_pass_vpn_user_01"
+    
+    state = await user_action_router(update_callback_admin, context)
+    
+    assert state == RESET_PASS
+    assert context.user_data['target_user'] == "vpn_user_01"
+
+@pytest.mark.asyncio
+async def test_process_add_data_bumps_limit(update_callback_admin, context, admin_patch, db_session):
+    from datetime import datetime, timedelta
+    from admin_panel import process_add_data, USER_ACTION
+    from models import User as DBUser, Subscription
+    
+    user = DBUser(telegram_id=55550001, username="add_data_owner")
+    db_session.add(user)
+    await db_session.flush()
+    sub = Subscription(
+        user_id=user.id,
+        mikrotik_username="add_data_user",
+        mikrotik_password="pass",
+        expiry_date=datetime.now() + timedelta(days=30),
+        total_limit_bytes=1024**3
+    )
+    db_session.add(sub)
+    await db_session.commit()
+    
+    update_callback_admin.message.text = "2"
+    context.user_data['target_user'] = "add_data_user"
+    
+    try:
+        with patch('admin_panel.mikrotik_pool'), patch('admin_panel.mt_call', AsyncMock()):
+            state = await process_add_data(update_callback_admin, context)
+        
+        assert state == USER_ACTION
+        await db_session.refresh(sub)
+        assert sub.total_limit_bytes == 3 * 1024**3
+    finally:
+        await db_session.delete(sub)
+        await db_session.delete(user)
+        await db_session.commit()
+
+@pytest.mark.asyncio
+async def test_live_lookup_breaker_skips_dead_router():
+    # After repeated connection failures the router is skipped without reconnecting
+    import admin_panel
+    
+    acquire = MagicMock(side_effect=ConnectionRefusedError("down"))
+    with patch.object(admin_panel.mikrotik_pool, 'acquire', acquire), \
+         patch.dict(admin_panel._breaker, clear=True):
+        for _ in range(admin_panel.BREAKER_THRESHOLD):
+            assert await admin_panel.safe_get_user_info(None, "someone") is None
+        assert acquire.call_count == admin_panel.BREAKER_THRESHOLD
+        
+        assert await admin_panel.safe_get_user_info(None, "someone") is None
+        assert acquire.call_count == admin_panel.BREAKER_THRESHOLD
+
+@pytest.mark.asyncio
+async def test_list_profiles_counts_active_users(update_callback_admin, context, admin_patch, db_session):
+    from datetime import datetime, timedelta
+    from admin_panel import list_profiles
+    from models import User as DBUser, Profile, Subscription
+    
+    user = DBUser(telegram_id=55550002, username="profile_count_owner")
+    profile = Profile(name="CountPlan", price=1.0, validity_days=30, data_limit_gb=10)
+    db_session.add_all([user, profile])
+    await db_session.flush()
+    subs = [
+        Subscription(user_id=user.id, profile_id=profile.id, mikrotik_username=f"count_user_{i}",
+                     mikrotik_password="pass", status=status,
+                     expiry_date=datetime.now() + timedelta(days=30))
+        for i, status in enumerate(["active", "active", "expired"])
+    ]
+    db_session.add_all(subs)
+    await db_session.commit()
+    
+    try:
+        await list_profiles(update_callback_admin, context)
+        
+        text = update_callback_admin.callback_query.edit_message_text.call_args.args[0]
+        block = text[text.index("**CountPlan**"):]
+        assert "Users: 2\n" in block
+        assert "📡 No server" in block
+    finally:
+        for obj in subs + [profile, user]:
+            await db_session.delete(obj)
+        await db_session.commit()
+
+@pytest.mark.asyncio
+async def test_server_cache_reused_until_invalidated(db_session):
+    import admin_panel
+    from models import Server
+    
+    admin_panel.invalidate_server_cache()
+    before = await admin_panel.get_servers_cached()
+    
+    server = Server(name="CacheSrv", host="10.9.9.9", username="admin", password="x", port=8728)
+    db_session.add(server)
+    await db_session.commit()
+    
+    try:
+        # Still served from cache within the TTL
+        assert await admin_panel.get_servers_cached() == before
+        
+        admin_panel.invalidate_server_cache()
+        assert (server.id, "CacheSrv") in await admin_panel.get_servers_cached()
+    finally:
+        await db_session.delete(server)
+        await db_session.commit()
+        admin_panel.invalidate_server_cache()
+
+@pytest.mark.asyncio
+async def test_profile_price_rejects_non_numeric(update_callback_admin, context):
+    from admin_panel import get_profile_price, PROFILE_PRICE
+    
+    for bad in ("abc", "nan", "1e3", "-5"):
+        update_callback_admin.message.text = bad
+        assert await get_profile_price(update_callback_admin, context) == PROFILE_PRICE
+    assert 'new_profile_price' not in context.user_data
+
+@pytest.mark.asyncio
+async def test_manual_export_runs_in_background(update_callback_admin, context):
+    import admin_panel
+    
+    context.bot = MagicMock()
+    context.bot.send_message = AsyncMock()
+    context.application = MagicMock()
+    
+    await admin_panel.manual_export(update_callback_admin, context)
+    
+    # Handler returns right away; the upload is handed to the application
+    coro = context.application.create_task.call_args.args[0]
+    update_callback_admin.callback_query.message.reply_text.assert_awaited_once()
+    
+    with patch.object(admin_panel.BackupManager, "send_backup_to_telegram", AsyncMock(return_value=False)):
+        await coro
+    context.bot.send_message.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_server_add_stores_encrypted_password(update_callback_admin, context, db_session):
+    from sqlalchemy import select
+    from admin_panel import server_port_received
+    from models import Server
+    
+    context.user_data.update(new_server_name="CoreInsertSrv", new_server_host="10.8.8.8",
+                             new_server_user="admin", new_server_pass="s3cret")
+    update_callback_admin.message.text = "8729"
+    
+    await server_port_received(update_callback_admin, context)
+    
+    server = (await db_session.execute(select(Server).where(Server.name == "CoreInsertSrv"))).scalar_one()
+    try:
+        assert server.port == 8729
+        assert server._password != "s3cret"
+        assert server.password == "s3cret"
+    finally:
+        await db_session.delete(server)
+        await db_session.commit()
+
+@pytest.mark.asyncio
+async def test_import_rejects_oversized_and_non_sqlite(update_callback_admin, context):
+    import admin_panel
+    
+    async def write_junk(path):
+        with open(path, "wb") as fh:
+            fh.write(b"not a database")
+    
+    doc = MagicMock(file_name="restore.db", file_size=admin_panel.MAX_IMPORT_BYTES + 1)
+    doc.get_file = AsyncMock(return_value=MagicMock(download_to_drive=AsyncMock(side_effect=write_junk)))
+    update_callback_admin.message.document = doc
+    
+    with patch.object(admin_panel.BackupManager, "restore_database", AsyncMock()) as restore:
+        assert await admin_panel.process_import(update_callback_admin, context) == admin_panel.WAIT_IMPORT_FILE
+        doc.get_file.assert_not_awaited()
+        
+        doc.file_size = 14
+        assert await admin_panel.process_import(update_callback_admin, context) == admin_panel.WAIT_IMPORT_FILE
+        restore.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_server_connection_test_fits_one_router_slot(update_callback_admin, context, db_session):
+    import asyncio
+    import admin_panel
+    from mikrotik_manager import MikroTikPool, MikroTikManager
+    from models import Server
+    
+    server = Server(name="SingleSlotSrv", host="10.9.9.9", username="admin", password="x", port=8728)
+    db_session.add(server)
+    await db_session.commit()
+    update_callback_admin.callback_query.data = f"server_test_{server.id}"
+    
+    resource = MagicMock()
+    resource.get.return_value = [{'cpu-load': '3', 'version': '7.14', 'uptime': '1d'}]
+    pool = MikroTikPool(max_per_router=1)
+    try:
+        with patch.object(admin_panel, "mikrotik_pool", pool), \
+             patch.object(MikroTikManager, "connect"), \
+             patch.object(MikroTikManager, "_get_resource", return_value=resource):
+            # Two at once on a single-connection router must both finish, not deadlock
+            await asyncio.wait_for(asyncio.gather(
+                admin_panel.test_server_connection(update_callback_admin, context),
+                admin_panel.test_server_connection(update_callback_admin, context),
+            ), timeout=2)
+        
+        text = update_callback_admin.callback_query.edit_message_text.call_args.args[0]
+        assert "Connection Successful" in text
+    finally:
+        await db_session.delete(server)
+        await db_session.commit()
+        invalidate_server_cache()
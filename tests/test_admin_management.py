@@ -0,0 +1,113 @@
+"""
+Admin Management Tests
+
+Tests for admin membership checks and the in-memory admin ID set.
+"""
+import pytest
+
+pytestmark = pytest.mark.unit
+
+
+class TestAdminMembership:
+    """Test add/remove/lookup of DB admins."""
+
+    @pytest.mark.asyncio
+    async def test_add_and_remove_admin(self, setup_db):
+        """Adding an admin is visible immediately; removing it revokes access."""
+        from admin_management import add_admin, remove_admin, is_user_admin
+
+        try:
+            assert await add_admin(77770001, username="mgmt_test") is True
+            assert await is_user_admin(77770001) is True
+
+            # Duplicate adds are rejected
+            assert await add_admin(77770001) is False
+        finally:
+            assert await remove_admin(77770001) is True
+
+        assert await is_user_admin(77770001) is False
+
+    @pytest.mark.asyncio
+    async def test_invalidate_reloads_from_db(self, db_session):
+        """Admins inserted out-of-band are picked up after invalidate()."""
+        import admin_management
+        from models import Admin
+
+        assert await admin_management.is_user_admin(77770002) is False
+
+        admin = Admin(telegram_id=77770002, username="oob_admin")
+        db_session.add(admin)
+        await db_session.commit()
+
+        try:
+            admin_management.invalidate()
+            assert await admin_management.is_user_admin(77770002) is True
+        finally:
+            await db_session.delete(admin)
+            await db_session.commit()
+            admin_management.invalidate()
+
+    @pytest.mark.asyncio
+    async def test_concurrent_cold_lookups_share_one_query(self, setup_db, mocker):
+        """Concurrent lookups on a cold cache issue a single admin ID query."""
+        import asyncio
+        import admin_management
+
+        spy = mocker.spy(admin_management, "list_admin_ids")
+        admin_management.invalidate()
+
+        results = await asyncio.gather(
+            *(admin_management.is_user_admin(77770003) for _ in range(10))
+        )
+
+        assert results == [False] * 10
+        assert spy.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_admin_list_cache_refreshes_on_change(self, setup_db):
+        """list_admins() is served from cache but reflects add/remove at once."""
+        from admin_management import add_admin, remove_admin, list_admins
+
+        await list_admins()
+        try:
+            assert await add_admin(77770004, username="list_cache") is True
+            assert 77770004 in [a.telegram_id for a in await list_admins()]
+        finally:
+            await remove_admin(77770004)
+
+        assert 77770004 not in [a.telegram_id for a in await list_admins()]
+
+    @pytest.mark.asyncio
+    async def test_expired_admin_ids_are_reloaded(self, db_session, mocker):
+        """Admins added out-of-band are picked up once the ID set's TTL runs out."""
+        import admin_management
+        from models import Admin
+
+        assert await admin_management.is_user_admin(77770005) is False
+
+        admin = Admin(telegram_id=77770005, username="ttl_admin")
+        db_session.add(admin)
+        await db_session.commit()
+
+        try:
+            assert await admin_management.is_user_admin(77770005) is False  # still cached
+            mocker.patch.object(admin_management, "_db_admin_ids_expires", 0.0)
+            assert await admin_management.is_user_admin(77770005) is True
+        finally:
+            await db_session.delete(admin)
+            await db_session.commit()
+            admin_management.invalidate()
+
+    @pytest.mark.asyncio
+    async def test_restore_drops_cached_admin_ids(self, mocker):
+        """A successful DB restore forces the next admin check to re-read the new file."""
+        import admin_management
+        import backup_manager
+
+        mocker.patch.object(backup_manager.os.path, "exists", return_value=False)
+        mocker.patch.object(backup_manager.os, "replace")
+        mocker.patch.object(backup_manager, "engine", mocker.MagicMock(dispose=mocker.AsyncMock()))
+        spy = mocker.spy(admin_management, "invalidate")
+
+        assert await backup_manager.BackupManager.restore_database("restored.db") is True
+        spy.assert_called_once()
@@ -0,0 +1,167 @@
+"""
+Admin Reports Tests
+
+Tests the sales dashboard metrics and CSV export.
+"""
+import codecs
+import gzip
+import re
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+pytestmark = pytest.mark.unit
+
+
+@pytest.fixture
+def update_callback():
+    update = MagicMock()
+    update.effective_chat.id = 12345678
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+    return update
+
+
+class TestSalesDashboard:
+    """Test the dashboard's aggregate figures."""
+
+    @pytest.mark.asyncio
+    async def test_dashboard_counts_revenue_and_subscriptions(self, db_session, update_callback):
+        """Today's purchases, old purchases and non-purchase rows land in the right buckets."""
+        import admin_reports
+        from admin_reports import sales_dashboard
+        from models import User, Subscription, Transaction
+
+        user = User(telegram_id=44440001, username="report_user")
+        db_session.add(user)
+        await db_session.flush()
+        now = datetime.utcnow()
+        rows = [
+            Transaction(user_id=user.id, amount=5.0, type='purchase', created_at=now),
+            Transaction(user_id=user.id, amount=7.0, type='purchase', created_at=now - timedelta(days=60)),
+            Transaction(user_id=user.id, amount=100.0, type='deposit', created_at=now),
+            Subscription(user_id=user.id, mikrotik_username="report_sub_active", mikrotik_password="x",
+                         expiry_date=now + timedelta(days=3)),
+            Subscription(user_id=user.id, mikrotik_username="report_sub_expired", mikrotik_password="x",
+                         expiry_date=now - timedelta(days=3)),
+        ]
+        db_session.add_all(rows)
+        await db_session.commit()
+
+        try:
+            admin_reports._dash_cache["text"] = None
+            await sales_dashboard(update_callback, MagicMock())
+
+            text = update_callback.callback_query.edit_message_text.call_args.args[0]
+            assert "Total Revenue: `$12.00`" in text
+            assert "Rev Today: `$5.00`" in text
+            assert "Rev Last 30d: `$5.00`" in text
+            assert "🟢 Active: `1`" in text
+            assert "🔴 Expired: `1`" in text
+        finally:
+            for obj in rows + [user]:
+                await db_session.delete(obj)
+            await db_session.commit()
+
+    @pytest.mark.asyncio
+    async def test_dashboard_is_cached_within_ttl(self, setup_db, update_callback, mocker):
+        """A second open within the TTL reuses the rendered text without querying."""
+        import admin_reports
+
+        admin_reports._dash_cache["text"] = None
+        spy = mocker.spy(admin_reports, "_render_dashboard")
+
+        await admin_reports.sales_dashboard(update_callback, MagicMock())
+        await admin_reports.sales_dashboard(update_callback, MagicMock())
+
+        assert spy.call_count == 1
+        first, second = update_callback.callback_query.edit_message_text.call_args_list
+        assert first.args[0] == second.args[0]
+
+    @pytest.mark.asyncio
+    async def test_unchanged_refresh_skips_edit(self, setup_db, update_callback):
+        """Refreshing a dashboard that already shows the current text only answers the query."""
+        import admin_reports
+
+        admin_reports._dash_cache["text"] = None
+        context = MagicMock()
+        context.chat_data = {}
+        query = update_callback.callback_query
+
+        await admin_reports.sales_dashboard(update_callback, context)
+        query.message.reply_markup = admin_reports.DASHBOARD_MARKUP
+        await admin_reports.sales_dashboard(update_callback, context)
+
+        assert query.edit_message_text.await_count == 1
+        query.answer.assert_awaited_with("Up to date")
+
+    @pytest.mark.asyncio
+    async def test_empty_database_skips_aggregates(self, setup_db, update_callback, mocker):
+        """With no users at all the dashboard shows zeros without running the aggregates."""
+        import admin_reports
+        from sqlalchemy import select
+        from models import User
+
+        # Stand-in for an empty users table
+        mocker.patch.object(admin_reports, "_ANY_USER", select(1).select_from(User).where(User.id < 0))
+        spy = mocker.spy(admin_reports, "_fetch_row")
+        admin_reports._dash_cache["text"] = None
+
+        await admin_reports.sales_dashboard(update_callback, MagicMock())
+        admin_reports._dash_cache["text"] = None
+
+        text = update_callback.callback_query.edit_message_text.call_args.args[0]
+        assert spy.call_count == 0
+        assert "Total Revenue: `$0.00`" in text
+        assert "Total Users: `0`" in text
+
+
+class TestSalesExport:
+    """Test the CSV export contents."""
+
+    @pytest.mark.asyncio
+    async def test_export_lists_purchases_only(self, db_session, update_callback):
+        """Only purchase transactions are exported, with the buyer's Telegram ID."""
+        from admin_reports import export_sales_csv
+        from models import User, Transaction
+
+        user = User(telegram_id=44440002, username="export_user")
+        db_session.add(user)
+        await db_session.flush()
+        rows = [
+            Transaction(user_id=user.id, amount=9.5, type='purchase', description="Plan A"),
+            Transaction(user_id=user.id, amount=50.0, type='deposit', description="Top-up"),
+        ]
+        db_session.add_all(rows)
+        await db_session.commit()
+
+        sent = {}
+
+        async def send_document(chat_id, document, filename, **kwargs):
+            sent["filename"] = filename
+            sent["raw"] = gzip.decompress(document.read())
+            sent["body"] = sent["raw"].decode("utf-8-sig")
+
+        context = MagicMock()
+        context.bot.send_document = AsyncMock(side_effect=send_document)
+
+        try:
+            await export_sales_csv(update_callback, context)
+
+            # The handler only schedules the export; run it here
+            context.bot.send_document.assert_not_awaited()
+            await context.application.create_task.call_args.args[0]
+
+            assert sent["filename"].endswith(".csv.gz")
+            assert sent["raw"].startswith(codecs.BOM_UTF8)
+            lines = sent["body"].splitlines()
+            assert lines[0] == "ID,Telegram ID,Amount,Date,Description"
+            purchase = next(line for line in lines[1:] if line.startswith(f"{rows[0].id},"))
+            assert purchase.startswith(f"{rows[0].id},44440002,9.5,")
+            assert purchase.endswith(",Plan A")
+            assert re.fullmatch(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}", purchase.split(",")[3])
+            assert "Top-up" not in sent["body"]
+        finally:
+            for obj in rows + [user]:
+                await db_session.delete(obj)
+            await db_session.commit()
@@ -0,0 +1,301 @@
+"""
+Admin Settings Tests
+
+Tests for reading and writing admin settings.
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+pytestmark = pytest.mark.unit
+
+
+class TestAdminSettingsStore:
+    """Test get/set of admin settings."""
+
+    @pytest.mark.asyncio
+    async def test_get_many_decodes_and_defaults(self, setup_db):
+        """Batch reads decode JSON values and fall back to defaults for missing keys."""
+        from admin_settings import set_admin_setting, get_admin_settings_many
+
+        await set_admin_setting('test_many_list', [1, 2, 3])
+        await set_admin_setting('test_many_text', 'hello')
+
+        values = await get_admin_settings_many(
+            ['test_many_list', 'test_many_text', 'test_many_missing'],
+            {'test_many_missing': 'fallback'},
+        )
+
+        assert values == {
+            'test_many_list': [1, 2, 3],
+            'test_many_text': 'hello',
+            'test_many_missing': 'fallback',
+        }
+
+    @pytest.mark.asyncio
+    async def test_reads_are_cached_and_writes_go_through(self, db_session):
+        """Repeat reads skip the DB; set_admin_setting updates the cache, out-of-band writes need invalidate."""
+        import admin_settings
+        from models import AdminSetting
+
+        await admin_settings.set_admin_setting('test_cached_cards', [{'number': '1'}])
+        await admin_settings.flush_admin_settings()
+
+        cards = await admin_settings.get_admin_setting('test_cached_cards', [])
+        cards.append({'number': '2'})  # caller mutation must not leak into the cache
+        assert await admin_settings.get_admin_setting('test_cached_cards', []) == [{'number': '1'}]
+
+        row = await db_session.get(AdminSetting, 'test_cached_cards')
+        row.value = '[]'
+        await db_session.commit()
+        assert await admin_settings.get_admin_setting('test_cached_cards', []) == [{'number': '1'}]
+
+        admin_settings.invalidate_admin_setting('test_cached_cards')
+        assert await admin_settings.get_admin_setting('test_cached_cards', ['default']) == []
+
+        await admin_settings.set_admin_setting('test_cached_cards', [{'number': '3'}])
+        assert await admin_settings.get_admin_setting('test_cached_cards', []) == [{'number': '3'}]
+
+    @pytest.mark.asyncio
+    async def test_concurrent_cold_reads_share_one_query(self, setup_db, mocker):
+        """Concurrent reads of an uncached key issue a single SELECT."""
+        import asyncio
+        import admin_settings
+
+        admin_settings.invalidate_admin_setting('test_inflight_key')
+        spy = mocker.spy(admin_settings, "_load_setting")
+
+        results = await asyncio.gather(
+            *(admin_settings.get_admin_setting('test_inflight_key', 'dflt') for _ in range(10))
+        )
+
+        assert results == ['dflt'] * 10
+        assert spy.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_batch_read_does_not_cache_over_concurrent_write(self, setup_db, mocker):
+        """A write that lands while a batch read is in flight is not overwritten by the stale row."""
+        import admin_settings
+        from database import AsyncSessionLocal
+
+        await admin_settings.set_admin_setting('test_race_key', 'old')
+        await admin_settings.flush_admin_settings()
+        admin_settings.invalidate_admin_setting('test_race_key')
+
+        session = AsyncSessionLocal()
+        real_execute = session.execute
+
+        async def execute_then_write(*args, **kwargs):
+            result = await real_execute(*args, **kwargs)
+            await admin_settings.set_admin_setting('test_race_key', 'new')
+            await admin_settings.flush_admin_settings()
+            return result
+
+        mocker.patch.object(session, "execute", side_effect=execute_then_write)
+        mocker.patch.object(admin_settings, "AsyncSessionLocal", return_value=session)
+
+        values = await admin_settings.get_admin_settings_many(['test_race_key'])
+
+        assert values == {'test_race_key': 'new'}
+        mocker.stopall()
+        assert await admin_settings.get_admin_setting('test_race_key') == 'new'
+
+    @pytest.mark.asyncio
+    async def test_writes_are_buffered_and_flushed_together(self, db_session):
+        """Several writes are readable at once and land in the DB in a single flush."""
+        import admin_settings
+        from models import AdminSetting
+
+        for i in range(3):
+            await admin_settings.set_admin_setting(f'test_buffered_{i}', [i])
+
+        assert await admin_settings.get_admin_setting('test_buffered_2') == [2]
+        admin_settings.invalidate_admin_setting('test_buffered_1')
+        assert await admin_settings.get_admin_setting('test_buffered_1') == [1]
+
+        await admin_settings.flush_admin_settings()
+        assert admin_settings._pending_writes == {}
+        for i in range(3):
+            row = await db_session.get(AdminSetting, f'test_buffered_{i}')
+            assert row.value == f'[{i}]'
+
+    @pytest.mark.asyncio
+    async def test_failed_flush_is_retried_on_a_timer(self, db_session, mocker):
+        """A flush the DB rejects goes back to the buffer and is retried without another write."""
+        import asyncio
+        import admin_settings
+        from database import AsyncSessionLocal
+        from models import AdminSetting
+
+        await admin_settings.flush_admin_settings()
+        mocker.patch.object(admin_settings, "FLUSH_INTERVAL", 0.01)
+        mocker.patch.object(admin_settings, "FLUSH_RETRY", 0.01)
+        mocker.patch.object(admin_settings, "AsyncSessionLocal",
+                            side_effect=[RuntimeError("db down"), AsyncSessionLocal()])
+
+        await admin_settings.set_admin_setting('test_retry_key', 'kept')
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if not admin_settings._pending_writes:
+                break
+
+        assert admin_settings._pending_writes == {}
+        row = await db_session.get(AdminSetting, 'test_retry_key')
+        assert row.value == 'kept'
+
+    @pytest.mark.asyncio
+    async def test_restore_discards_buffer_and_caches(self, setup_db, mocker):
+        """A DB restore drops unflushed writes and every cached setting and server list."""
+        import admin_panel
+        import admin_settings
+        import backup_manager
+
+        await admin_settings.set_admin_setting('test_restore_key', 'old data')
+        await admin_panel.get_servers_cached()
+        mocker.patch.object(backup_manager.os.path, "exists", return_value=False)
+        mocker.patch.object(backup_manager.os, "replace")
+        mocker.patch.object(backup_manager, "engine", mocker.MagicMock(dispose=mocker.AsyncMock()))
+
+        assert await backup_manager.BackupManager.restore_database("restored.db") is True
+
+        assert admin_settings._pending_writes == {}
+        assert admin_settings._settings_cache == {}
+        assert admin_panel._server_cache["ts"] == 0.0
+
+
+class TestPaymentCardsMenu:
+    """Test the payment cards menu."""
+
+    @pytest.mark.asyncio
+    async def test_cards_are_masked(self, setup_db):
+        """Each card shows its first and last four digits and gets a delete button."""
+        import admin_settings
+
+        update = MagicMock()
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        cards = [{'number': '6037997412341234', 'bank': 'Melli'}]
+        previous = await admin_settings.get_admin_setting('payment_cards', [])
+
+        try:
+            await admin_settings.set_admin_setting('payment_cards', cards)
+            await admin_settings.manage_payment_cards(update, MagicMock())
+
+            call = update.callback_query.edit_message_text.call_args
+            assert "1. `6037-****-****-1234` (Melli)" in call.args[0]
+            keys = [b.callback_data for row in call.kwargs['reply_markup'].inline_keyboard for b in row]
+            assert keys[0] == 'card_delete_0'
+        finally:
+            await admin_settings.set_admin_setting('payment_cards', previous)
+            await admin_settings.flush_admin_settings()
+
+    @pytest.mark.asyncio
+    async def test_delete_refresh_is_served_from_cache(self, setup_db, mocker):
+        """Deleting a card re-renders the menu without reading the DB again."""
+        import admin_settings
+
+        update = MagicMock()
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        update.callback_query.data = 'card_delete_0'
+        previous = await admin_settings.get_admin_setting('payment_cards', [])
+
+        try:
+            await admin_settings.set_admin_setting('payment_cards', [{'number': '6037997412341234', 'bank': 'A'}])
+            mocker.patch.object(admin_settings, "AsyncSessionLocal", side_effect=AssertionError("DB hit"))
+            await admin_settings.delete_card(update, MagicMock())
+
+            assert "No cards configured." in update.callback_query.edit_message_text.call_args.args[0]
+        finally:
+            mocker.stopall()
+            await admin_settings.set_admin_setting('payment_cards', previous)
+            await admin_settings.flush_admin_settings()
+
+
+class TestCustomMessagesMenu:
+    """Test the custom messages menu and editor."""
+
+    @pytest.mark.asyncio
+    async def test_menu_prefetches_messages_for_editor(self, db_session, mocker):
+        """Opening the menu loads every template once; the editor then reads from cache."""
+        import admin_settings
+        from models import AdminSetting
+
+        await admin_settings.set_admin_setting('buy_service_text', 'Pick a plan')
+        await admin_settings.flush_admin_settings()
+        admin_settings.invalidate_admin_setting()
+
+        update = MagicMock()
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        context = MagicMock()
+        context.user_data = {}
+
+        try:
+            await admin_settings.manage_custom_messages(update, context)
+
+            mocker.patch.object(admin_settings, "AsyncSessionLocal", side_effect=AssertionError("DB hit"))
+            update.callback_query.data = 'msg_edit_buy_service_text'
+            await admin_settings.edit_message_start(update, context)
+
+            assert context.user_data['message_key'] == 'buy_service_text'
+            assert "Pick a plan" in update.callback_query.edit_message_text.call_args.args[0]
+        finally:
+            mocker.stopall()
+            await db_session.delete(await db_session.get(AdminSetting, 'buy_service_text'))
+            await db_session.commit()
+            admin_settings.invalidate_admin_setting()
+
+
+class TestConnectionInfo:
+    """Test per-server connection info storage."""
+
+    @pytest.mark.asyncio
+    async def test_legacy_blob_is_split_per_server(self, setup_db, mocker):
+        """The old all-servers blob is moved into per-server keys on first read."""
+        import admin_settings
+
+        info = {'l2tp': {'ip': '10.1.1.1', 'port': 1701, 'secret': 's'}, 'sstp': {'ip': '', 'port': 443}}
+        await admin_settings.set_admin_setting('connection_info', {'901': info})
+        mocker.patch.object(admin_settings, '_conn_info_migrated', False)
+
+        try:
+            assert await admin_settings.get_connection_info(901) == info
+            assert await admin_settings.get_connection_info(902, 'none') == 'none'
+            assert await admin_settings.get_admin_setting('connection_info') == {}
+            assert await admin_settings.get_admin_setting('connection_info:901') == info
+        finally:
+            await admin_settings.set_admin_setting('connection_info:901', '')
+            await admin_settings.flush_admin_settings()
+
+    @pytest.mark.asyncio
+    async def test_all_skipped_save_writes_nothing(self, setup_db, mocker):
+        """Skipping every field (or re-entering the stored values) doesn't touch the DB."""
+        import admin_settings
+
+        mocker.patch('admin_panel.admin_start', AsyncMock())
+        set_spy = mocker.spy(admin_settings, 'set_admin_setting')
+        update = MagicMock()
+        update.message.text = '/skip'
+        update.message.reply_text = AsyncMock()
+        context = MagicMock()
+        context.user_data = {'conn_server_id': 903}
+
+        await admin_settings.receive_sstp_ip(update, context)
+
+        set_spy.assert_not_called()
+        update.message.reply_text.assert_awaited_with("Connection info unchanged.")
+
+
+class TestSettingsMenuRouting:
+    """Test the SETTINGS_MENU callback dispatcher."""
+
+    def test_routes_exact_and_prefixed_callbacks(self):
+        """Exact callbacks and prefixed ones (including keys with underscores) find their handler."""
+        import admin_settings as s
+
+        assert s._route_settings_callback('settings_cards') is s.manage_payment_cards
+        assert s._route_settings_callback('card_delete_3') is s.delete_card
+        assert s._route_settings_callback('msg_edit_welcome_message') is s.edit_message_start
+        assert s._route_settings_callback('conn_server_12') is s.edit_connection_info
+        assert s._route_settings_callback('card_delete') is None
+        assert s._route_settings_callback('admin_start') is None
@@ -0,0 +1,139 @@
+"""
+MikroTik Connection Pool Tests
+
+Tests connection reuse and expiry in MikroTikPool without a router
+(MikroTikManager.connect/close are patched out).
+"""
+import pytest
+from unittest.mock import MagicMock, patch
+
+pytestmark = pytest.mark.unit
+
+
+@pytest.fixture
+def pool():
+    from mikrotik_manager import MikroTikPool
+    with patch("mikrotik_manager.MikroTikManager.connect") as connect, \
+         patch("mikrotik_manager.MikroTikManager.close") as close:
+        p = MikroTikPool()
+        p.connect_mock = connect
+        p.close_mock = close
+        yield p
+
+
+class TestMikroTikPool:
+    """Test acquire/release behaviour of the pool."""
+
+    @pytest.mark.asyncio
+    async def test_connection_is_reused(self, pool):
+        """A released connection is handed out again without reconnecting."""
+        async with pool.acquire() as first:
+            pass
+        async with pool.acquire() as second:
+            pass
+
+        assert first is second
+        assert pool.connect_mock.call_count == 1
+        pool.close_mock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_failed_connection_is_not_reused(self, pool):
+        """A connection used in a failing block is closed, not returned to the pool."""
+        with pytest.raises(RuntimeError):
+            async with pool.acquire() as first:
+                raise RuntimeError("boom")
+
+        async with pool.acquire() as second:
+            pass
+
+        assert first is not second
+        assert pool.close_mock.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_idle_connections_are_evicted(self, pool):
+        """Connections idle longer than idle_timeout are closed by the janitor pass."""
+        pool.idle_timeout = -1
+        async with pool.acquire():
+            pass
+
+        await pool.evict_expired()
+
+        assert pool.close_mock.call_count == 1
+        assert not pool._free
+
+    @pytest.mark.asyncio
+    async def test_concurrent_connections_are_bounded(self, pool):
+        """No more than max_per_router connections to one router are open at once."""
+        import asyncio
+
+        pool.max_per_router = 2
+        in_use = 0
+        peak = 0
+
+        async def use():
+            nonlocal in_use, peak
+            async with pool.acquire():
+                in_use += 1
+                peak = max(peak, in_use)
+                await asyncio.sleep(0.01)
+                in_use -= 1
+
+        await asyncio.gather(*(use() for _ in range(6)))
+
+        assert peak == 2
+        assert pool.connect_mock.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_connection_error_in_wrapper_evicts_connection(self, pool):
+        """A transport error swallowed by a wrapper still keeps the socket out of the pool."""
+        from routeros_api.exceptions import RouterOsApiConnectionClosedError
+
+        async with pool.acquire() as first:
+            first.api = MagicMock()
+            first.api.get_resource.side_effect = RouterOsApiConnectionClosedError("closed")
+            assert first.disable_user("someone") is False
+
+        async with pool.acquire() as second:
+            pass
+
+        assert first is not second
+        assert pool.close_mock.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_command_error_keeps_connection(self, pool):
+        """A router-side !trap for one command does not cost the pooled session."""
+        from routeros_api.exceptions import RouterOsApiCommunicationError
+
+        async with pool.acquire() as first:
+            first.api = MagicMock()
+            first.api.get_resource.side_effect = RouterOsApiCommunicationError("no such item", b"")
+            assert first.disable_user("someone") is False
+
+        async with pool.acquire() as second:
+            pass
+
+        assert first is second
+        pool.close_mock.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_dead_idle_connection_is_replaced(self, pool):
+        """A reused connection that fails the liveness probe is closed and reconnected."""
+        pool.PROBE_AFTER = -1
+        async with pool.acquire() as first:
+            pass
+
+        with patch("mikrotik_manager.MikroTikManager.ping", side_effect=OSError("reset")):
+            async with pool.acquire() as second:
+                pass
+
+        assert first is not second
+        assert pool.connect_mock.call_count == 2
+        assert pool.close_mock.call_count == 1
+
+    def test_default_key_uses_configured_port(self):
+        """The config-default router is keyed by MIKROTIK_PORT, not the stock API port."""
+        from config import config
+        from mikrotik_manager import MikroTikPool
+
+        with patch.object(config, "MIKROTIK_PORT", 18728):
+            assert MikroTikPool._key(None)[1] == 18728
@@ -0,0 +1,48 @@
+"""
+Notification Manager Tests
+
+Tests broadcast fan-out and its handling of blocked users and flood limits.
+"""
+import pytest
+from unittest.mock import AsyncMock
+
+pytestmark = pytest.mark.unit
+
+
+class TestBroadcast:
+    """Test broadcast_to_all stats and retries."""
+
+    @pytest.mark.asyncio
+    async def test_broadcast_counts_blocked_and_retries_flood(self, db_session):
+        """Blocked users are counted; a RetryAfter is retried once after the pause."""
+        from telegram.error import Forbidden, RetryAfter
+        from models import User
+        from notification_manager import NotificationManager
+
+        users = [User(telegram_id=66660000 + i, username=f"bcast_{i}") for i in range(3)]
+        db_session.add_all(users)
+        await db_session.commit()
+
+        flooded = []
+
+        async def send_message(chat_id, text, parse_mode):
+            if chat_id == 66660001:
+                raise Forbidden("blocked")
+            if chat_id == 66660002 and not flooded:
+                flooded.append(chat_id)
+                raise RetryAfter(0)
+
+        bot = AsyncMock()
+        bot.send_message.side_effect = send_message
+
+        try:
+            stats = await NotificationManager(bot).broadcast_to_all("hello")
+
+            assert stats["blocked"] == 1
+            assert stats["failed"] == 0
+            assert stats["success"] == stats["total"] - 1
+            assert bot.send_message.await_count == stats["total"] + 1
+        finally:
+            for user in users:
+                await db_session.delete(user)
+            await db_session.commit()
@@ -37,12 +37,16 @@ import time
 
 user_last_action = {}
 
+def elapsed_ms(start_ns: int) -> float:
+    """Milliseconds elapsed since a time.perf_counter_ns() reading."""
+    return (time.perf_counter_ns() - start_ns) / 1e6
+
 def rate_limit(seconds=2):
     def decorator(func):
         @wraps(func)
         async def wrapper(update, context, *args, **kwargs):
             user_id = update.effective_user.id
-            current_time = time.time()
+            current_time = time.monotonic()
             if user_id in user_last_action:
                 elapsed = current_time - user_last_action[user_id]
                 if elapsed < seconds: